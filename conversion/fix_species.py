@@ -1,5 +1,8 @@
 #
-# Fix data curation errors with the wrong species ontology.
+# Fix data curation errors with the wrong ontology ids.
+#
+# The corrections are listed in a rules file, by default ontology_rules.yaml,
+# for example:
 #
 # 1. subject species has NCBITaxon instead of NCBITAXON
 # 2. subject species has 9096 instead of 9606 for human
@@ -8,15 +11,24 @@
 #
 
 import json
-from dotenv import load_dotenv
 import os
+import sys
 import yaml
-import requests
 import argparse
 import urllib.parse
+import hashlib
+import http.client
+import threading
+import time
+import tapis_client
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
 
 # Setup
 def getConfig():
+    # imported here so checkConversion and loadRules can be used by
+    # query_cache.py without python-dotenv installed
+    from dotenv import load_dotenv
     if load_dotenv(dotenv_path='/vdjserver-web-api/.env'):
         cfg = {}
         cfg['api_server'] = os.getenv('WSO2_HOST')
@@ -30,111 +42,377 @@ def getConfig():
         print('ERROR: loading config')
         return None
 
-# Fetches a user token based on the supplied auth object
-# and returns the auth object with token data on success
-def getToken(config):
-    data = {
-        "grant_type":"password",
-        "scope":"PRODUCTION",
-        "username":config['username'],
-        "password":config['password']
-    }
-    headers = {
-        "Content-Type":"application/x-www-form-urlencoded"
-    }
-
-    url = 'https://' + config['api_server'] + '/token'
-
-    resp = requests.post(url, data=data, headers=headers, auth=(config['api_key'], config['api_secret']))
-    token = resp.json()
-    return token
-
-def querySubjects(token, config, limit, offset):
-    headers = {
-        "Content-Type":"application/json",
-        "Accept": "application/json",
-        "Authorization": "Bearer " + token['access_token']
-    }
-    url = 'https://' + config['api_server'] + '/meta/v2/data?q=' + urllib.parse.quote('{"name":"subject"}') + '&limit=' + str(limit) + '&offset=' + str(offset)
-    resp = requests.get(url, headers=headers)
-    #print(json.dumps(resp.json(), indent=2))
-    result = resp.json()['result']
-    print('INFO: Query returned', len(result), 'subject records.')
-    return resp.json()['result']
-
-# Load all of the subject metadata records
-def getSubjects(token, config):
-    offset = 0
-    limit = 100
-    query_list = querySubjects(token, config, limit, offset)
-    subjects = []
-    subjects += query_list
-    done = False
-    while not done:
-        if len(query_list) > 0:
-            offset = offset + limit
-            query_list = querySubjects(token, config, limit, offset)
-            subjects += query_list
+# Connects to the API and logs in as the service account. The token is
+# cached on disk and reused by later runs until shortly before it expires.
+def getClient(config, pool_size=4, token_cache=tapis_client.DEFAULT_TOKEN_CACHE):
+    cache = tapis_client.TokenCache(token_cache) if token_cache else None
+    client = tapis_client.TapisClient('https://' + config['api_server'], token_cache=cache, pool_size=pool_size)
+    client.authenticate(config['username'], config['password'], config['api_key'], config['api_secret'])
+    return client
+
+# Counts what the queries transferred, to show the cost of a scan
+class ScanStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.records = 0
+        self.bytes = 0
+
+    def add(self, records, nbytes):
+        with self.lock:
+            self.queries += 1
+            self.records += records
+            self.bytes += nbytes
+
+    def report(self):
+        print('INFO:', self.records, 'records scanned,', self.bytes, 'bytes transferred in', self.queries, 'queries.')
+
+def queryMetadata(client, query, fields, limit, offset, stats=None):
+    url = '/meta/v2/data?q=' + urllib.parse.quote(json.dumps(query)) + '&limit=' + str(limit) + '&offset=' + str(offset)
+    if fields:
+        url += '&filter=' + urllib.parse.quote(','.join(fields))
+    timing = {}
+    status, headers, data = client.json('GET', url, timing=timing)
+    #print(json.dumps(data, indent=2))
+    if status != 200:
+        raise tapis_client.HTTPResponseError(status, 'metadata query failed with status ' + str(status))
+    result = data['result']
+    if stats:
+        stats.add(len(result), timing['response_bytes'])
+    print('INFO: Query returned', len(result), 'metadata records.')
+    return result
+
+# Get the full metadata record
+def getMetadataRecord(client, uuid):
+    status, headers, data = client.json('GET', '/meta/v2/data/' + uuid)
+    if status != 200:
+        print('ERROR: metadata uuid', uuid, 'could not be read, status', status)
+        return None
+    return data['result']
+
+# Load all of the metadata records matching the query, with window pages
+# prefetched concurrently.
+def getMetadata(client, query, fields=None, limit=100, window=4, stats=None):
+    total = 0
+    fetch = lambda limit, offset: queryMetadata(client, query, fields, limit, offset, stats)
+    for obj in tapis_client.paginate(fetch, limit, window):
+        total += 1
+        yield obj
+    print('INFO:', total, 'total metadata records.')
+
+# HTTP status codes which are retried
+RETRY_STATUS = [429, 500, 502, 503, 504]
+
+# Longest URL encoded query and filter, well under the URL limits of the
+# gateway and proxies
+MAX_QUERY_LENGTH = 6000
+
+# Spaces requests evenly so that all workers together stay under the
+# given number of requests per second.
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate and rate > 0 else 0.0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if self.interval == 0.0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+# Update a metadata record, retrying with exponential backoff when the
+# gateway is rate limiting or the service is unavailable. Returns True
+# if the record was updated.
+def updateMetadata(client, obj, limiter=None, retries=5, backoff=1.0):
+    url = '/meta/v2/data/' + obj['uuid']
+    for attempt in range(retries + 1):
+        if limiter:
+            limiter.wait()
+        delay = backoff * (2 ** attempt)
+        try:
+            status, headers, data = client.request('POST', url, obj, { 'Accept': 'application/json' })
+        except (OSError, http.client.HTTPException, tapis_client.HTTPResponseError) as e:
+            print('WARNING: metadata uuid', obj['uuid'], 'update error:', e)
         else:
-            done = True
-    print('INFO:', len(subjects), 'total subject records.')
-    return subjects
-
-def updateSubject(token, config, subject):
-    headers = {
-        "Content-Type":"application/json",
-        "Accept": "application/json",
-        "Authorization": "Bearer " + token['access_token']
-    }
-    url = 'https://' + config['api_server'] + '/meta/v2/data/' + subject['uuid']
-    resp = requests.post(url, json=subject, headers=headers)
-    #print(json.dumps(resp.json(), indent=2))
-    print('INFO: subject uuid', subject['uuid'], 'updated.')
-    return
+            if status == 200:
+                #print(data.decode('utf-8'))
+                print('INFO: metadata uuid', obj['uuid'], 'updated.')
+                return True
+            if status not in RETRY_STATUS:
+                print('ERROR: metadata uuid', obj['uuid'], 'update failed with status', status)
+                return False
+            print('WARNING: metadata uuid', obj['uuid'], 'update returned status', status)
+            if (headers.get('Retry-After') or '').isdigit():
+                delay = max(delay, int(headers['Retry-After']))
+        if attempt < retries:
+            time.sleep(delay)
+    print('ERROR: metadata uuid', obj['uuid'], 'update failed after', retries + 1, 'attempts')
+    return False
+
+# Performs updates on a bounded pool of workers and appends the uuid of
+# every updated record to a journal file. Records in the journal from a
+# previous run are skipped, so an interrupted conversion resumes where it
+# stopped. Queries only return the fields needed for checking, so the
+# full record is read and converted again before it is updated.
+class UpdateEngine:
+    def __init__(self, client, rules, journal, workers=4, rate=10, retries=5):
+        self.client = client
+        self.rules = rules
+        self.retries = retries
+        self.limiter = RateLimiter(rate)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # bound the records waiting for a worker
+        self.slots = threading.BoundedSemaphore(workers * 2)
+        self.lock = threading.Lock()
+        self.done = set()
+        if os.path.exists(journal):
+            with open(journal, 'r') as fp:
+                for line in fp:
+                    if line.strip():
+                        self.done.add(line.strip())
+            print('INFO:', len(self.done), 'records already updated in journal', journal)
+        self.journal = open(journal, 'a')
+        self.futures = []
+        # later scan passes find pending and failed records again, so
+        # failed and skipped records are kept by uuid
+        self.updated = 0
+        self.skipped = set()
+        self.failed = set()
+        self.start = time.monotonic()
+
+    def isDone(self, uuid):
+        return uuid in self.done
+
+    def skip(self, uuid):
+        self.skipped.add(uuid)
+
+    def _update(self, obj):
+        try:
+            self.limiter.wait()
+            try:
+                full = getMetadataRecord(self.client, obj['uuid'])
+            except Exception as e:
+                # counted as failed so the watermark is not moved past it
+                print('ERROR: metadata uuid', obj['uuid'], 'could not be read:', e)
+                full = None
+            if full is None:
+                ok = False
+            else:
+                result = checkConversion(full, self.rules, quiet=True)
+                if not result['check']:
+                    print('INFO: metadata uuid', obj['uuid'], 'no longer needs conversion.')
+                    with self.lock:
+                        self.failed.discard(obj['uuid'])
+                    return
+                ok = updateMetadata(self.client, result['object'], self.limiter, self.retries)
+            with self.lock:
+                if ok:
+                    self.updated += 1
+                    self.failed.discard(obj['uuid'])
+                    self.journal.write(obj['uuid'] + '\n')
+                    self.journal.flush()
+                else:
+                    self.failed.add(obj['uuid'])
+        finally:
+            self.slots.release()
+
+    def submit(self, obj):
+        if self.isDone(obj['uuid']):
+            self.skip(obj['uuid'])
+            return
+        self.slots.acquire()
+        self.futures.append(self.executor.submit(self._update, obj))
+
+    def wait(self):
+        # wait for the submitted updates to finish
+        futures.wait(self.futures)
+        # raise any error of an update rather than losing it in its future
+        for future in self.futures:
+            future.result()
+        self.futures = []
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.journal.close()
+        elapsed = time.monotonic() - self.start
+        print('INFO:', self.updated, 'records updated,', len(self.failed), 'failed,', len(self.skipped), 'skipped from journal.')
+        if elapsed > 0:
+            print('INFO: %.1f updates per second over %.1f seconds.' % (self.updated / elapsed, elapsed))
+
+# Load the rules file and compile it into a lookup of
+#   name -> field path -> { bad id: corrected id }
+# so checking a record costs one dictionary lookup for each field path of
+# its name, however many rules there are. Chains of rewrites are resolved
+# here so each id is rewritten once to its final value.
+def loadRules(filename):
+    with open(filename, 'r') as fp:
+        rule_list = yaml.safe_load(fp)
+    rules = {}
+    for rule in rule_list:
+        path = tuple(rule['path'].split('.'))
+        rewrite = rules.setdefault(rule['name'], {}).setdefault(path, {})
+        for bad_id, good_id in rule['rewrite'].items():
+            bad_id = str(bad_id)
+            good_id = str(good_id)
+            if rewrite.get(bad_id, good_id) != good_id:
+                raise ValueError('conflicting rules for ' + rule['name'] + ' ' + rule['path'] + ' ' + bad_id)
+            rewrite[bad_id] = good_id
+    for name in rules:
+        for path, rewrite in rules[name].items():
+            for bad_id in list(rewrite.keys()):
+                good_id = rewrite[bad_id]
+                seen = set([bad_id])
+                while good_id in rewrite and good_id != rewrite[good_id]:
+                    if good_id in seen:
+                        raise ValueError('cyclic rules for ' + name + ' ' + '.'.join(path) + ' ' + bad_id)
+                    seen.add(good_id)
+                    good_id = rewrite[good_id]
+                rewrite[bad_id] = good_id
+            # identity rules never change anything
+            for bad_id in [k for k, v in rewrite.items() if k == v]:
+                del rewrite[bad_id]
+    return rules
+
+# Build the metadata query and field projection from the rules, so the
+# server only returns records with a bad id and only the fields needed to
+# check them. MongoDB matches dotted paths through arrays. With a
+# watermark only records modified after it are returned.
+#
+# The query goes in the URL, so a large rule table is split into several
+# queries which each stay under MAX_QUERY_LENGTH once URL encoded.
+def buildQueries(rules, since=None):
+    queries = []
+    clauses = []
+    fields = ['uuid', 'name', 'associationIds']
+
+    def makeQuery(clauses):
+        query = { '$or': clauses }
+        if since is not None:
+            query['lastUpdated'] = { '$gt': { '$date': since } }
+        return query
+
+    def encodedLength(clauses, fields):
+        return len(urllib.parse.quote(json.dumps(makeQuery(clauses)))) + len(urllib.parse.quote(','.join(fields)))
+
+    def finishQuery():
+        if clauses:
+            queries.append((makeQuery(list(clauses)), list(fields)))
+        del clauses[:]
+        del fields[3:]
+
+    for name in sorted(rules.keys()):
+        for path, rewrite in rules[name].items():
+            if len(rewrite) == 0:
+                continue
+            field = 'value.' + '.'.join(path)
+            ids = []
+            clause = { 'name': name, field + '.id': { '$in': ids } }
+            for bad_id in sorted(rewrite.keys()):
+                if not ids:
+                    if field not in fields:
+                        fields.append(field)
+                    clauses.append(clause)
+                ids.append(bad_id)
+                if encodedLength(clauses, fields) > MAX_QUERY_LENGTH and (len(ids) > 1 or len(clauses) > 1):
+                    # move the id to a new query
+                    ids.pop()
+                    if not ids:
+                        clauses.pop()
+                    finishQuery()
+                    ids = [bad_id]
+                    clause = { 'name': name, field + '.id': { '$in': ids } }
+                    fields.append(field)
+                    clauses.append(clause)
+    finishQuery()
+    return queries
+
+# The watermark is the start time of the last run which committed all of
+# its updates, along with a hash of the rules used. New or changed rules
+# may match records that have not been modified since, so they force a
+# full scan.
+def rulesHash(filename):
+    with open(filename, 'rb') as fp:
+        return hashlib.sha256(fp.read()).hexdigest()
+
+def loadWatermark(filename, rules_hash):
+    if not os.path.exists(filename):
+        print('INFO: No watermark file', filename + ', performing full scan.')
+        return None
+    with open(filename, 'r') as fp:
+        watermark = json.load(fp)
+    if watermark.get('rules_sha256') != rules_hash:
+        print('INFO: Rules changed since the watermark, performing full scan.')
+        return None
+    print('INFO: Scanning records updated after', watermark['lastUpdated'])
+    return watermark['lastUpdated']
+
+def saveWatermark(filename, last_updated, rules_hash):
+    # write then rename, so an interrupted write keeps the old watermark
+    partial = filename + '.partial'
+    with open(partial, 'w') as fp:
+        json.dump({ 'lastUpdated': last_updated, 'rules_sha256': rules_hash }, fp, indent=2)
+    os.replace(partial, filename)
+    print('INFO: Watermark advanced to', last_updated)
+
+# Ontology objects at the field path, arrays along the path are expanded
+def findOntologies(value, path):
+    if isinstance(value, list):
+        for item in value:
+            yield from findOntologies(item, path)
+        return
+    if not isinstance(value, dict):
+        return
+    if len(path) == 0:
+        yield value
+        return
+    if path[0] in value:
+        yield from findOntologies(value[path[0]], path[1:])
 
 # Check and perform the conversion
-def checkConversion(subject):
+def checkConversion(obj, rules, quiet=False):
     result = { 'check': False, 'object': None }
     # error checks
-    if subject.get('uuid') is None:
-        return result
-    if subject.get('value') is None:
+    if obj.get('uuid') is None:
         return result
-    if subject['value'].get('species') is None:
+    if obj.get('value') is None:
         return result
-    if type(subject['value']['species']) is not dict:
-        return result
-    if subject['value']['species'].get('id') is None:
+    paths = rules.get(obj.get('name'))
+    if paths is None:
         return result
 
     # conversion
-    if subject['value']['species']['id'] == 'NCBITaxon:9096':
-        print('INFO: subject uuid', subject['uuid'], 'converting (', subject['value']['species']['id'], ') to (NCBITAXON:9606)')
-        subject['value']['species']['id'] = 'NCBITAXON:9606'
-        result['check'] = True
-        result['object'] = subject
-    if subject['value']['species']['id'] == 'NCBITAXON:9096':
-        print('INFO: subject uuid', subject['uuid'], 'converting (', subject['value']['species']['id'], ') to (NCBITAXON:9606)')
-        subject['value']['species']['id'] = 'NCBITAXON:9606'
-        result['check'] = True
-        result['object'] = subject
-    if subject['value']['species']['id'] == 'NCBITaxon:9606':
-        print('INFO: subject uuid', subject['uuid'], 'converting (', subject['value']['species']['id'], ') to (NCBITAXON:9606)')
-        subject['value']['species']['id'] = 'NCBITAXON:9606'
-        result['check'] = True
-        result['object'] = subject
-    if subject['value']['species']['id'] == 'NCBITaxon:10090':
-        print('INFO: subject uuid', subject['uuid'], 'converting (', subject['value']['species']['id'], ') to (NCBITAXON:10090)')
-        subject['value']['species']['id'] = 'NCBITAXON:10090'
-        result['check'] = True
-        result['object'] = subject
+    for path, rewrite in paths.items():
+        for ontology in findOntologies(obj['value'], path):
+            if not isinstance(ontology.get('id'), str):
+                continue
+            good_id = rewrite.get(ontology['id'])
+            if good_id is not None:
+                if not quiet:
+                    print('INFO:', obj['name'], 'uuid', obj['uuid'], 'converting (', ontology['id'], ') to (' + good_id + ')')
+                ontology['id'] = good_id
+                result['check'] = True
+                result['object'] = obj
 
     return result
 
 # main entry
 if (__name__=="__main__"):
-    parser = argparse.ArgumentParser(description='Fix subject species ontology.')
+    parser = argparse.ArgumentParser(description='Fix ontology ids in metadata records.')
     parser.add_argument('-c', '--convert', help='Perform conversion operations', action="store_true", required=False)
+    parser.add_argument('-r', '--rules', help='Ontology rewrite rules file', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ontology_rules.yaml'), required=False)
+    parser.add_argument('-w', '--window', help='Number of pages to prefetch concurrently', type=int, default=4, required=False)
+    parser.add_argument('--workers', help='Number of concurrent updates', type=int, default=4, required=False)
+    parser.add_argument('--rate', help='Maximum updates per second, 0 for no limit', type=float, default=10, required=False)
+    parser.add_argument('--retries', help='Number of retries for a failed update', type=int, default=5, required=False)
+    parser.add_argument('--journal', help='Journal of updated uuids for resuming a conversion', type=str, default='fix_species.journal', required=False)
+    parser.add_argument('--watermark', help='File with the time of the last completed conversion', type=str, default='fix_species.watermark', required=False)
+    parser.add_argument('--full', help='Scan all records, ignoring the watermark', action="store_true", required=False)
+    parser.add_argument('--token-cache', help='File for caching the login token, empty to disable', type=str, default=tapis_client.DEFAULT_TOKEN_CACHE, required=False)
     args = parser.parse_args()
 
     if args:
@@ -143,24 +421,75 @@ if (__name__=="__main__"):
         else:
             print('INFO: Conversion not enabled, will only describe modifications.')
 
+        rules = loadRules(args.rules)
         config = getConfig()
-        token = getToken(config)
+        # one connection for each prefetched page and update worker
+        client = getClient(config, max(1, args.window) + max(1, args.workers), args.token_cache)
+
+        engine = None
+        if args.convert:
+            engine = UpdateEngine(client, rules, args.journal, max(1, args.workers), args.rate, args.retries)
+
+        # Only records modified since the last completed run are scanned.
+        # The run start time is taken before the first query, so records
+        # modified while the run is in progress are scanned again next time.
+        rules_hash = rulesHash(args.rules)
+        since = None
+        if not args.full:
+            since = loadWatermark(args.watermark, rules_hash)
+        run_start = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
 
+        # Updated records no longer match the query, which shifts the pages
+        # of a scan that is still running, so when converting the scan is
+        # repeated until a pass has nothing left to update.
+        queries = buildQueries(rules, since)
+        if len(queries) > 1:
+            print('INFO: Rules split into', len(queries), 'queries.')
+        stats = ScanStats()
         projects = []
-        subjects = getSubjects(token, config)
-        cnt = 0
-        for subject in subjects:
-            #print(subject)
-            result = checkConversion(subject)
-            if result['check']:
-                cnt += 1
-                if subject.get('associationIds'):
-                    for p in subject['associationIds']:
-                        if p not in projects:
-                            projects.append(p)
-                if args.convert:
-                    print('INFO: Updating subject record.')
-                    updateSubject(token, config, result['object'])
-        print('INFO:', cnt, 'total subjects converted.')
+        # records still pending or failed are found again by later passes,
+        # so they are counted by uuid
+        converted = set()
+        while True:
+            updated = engine.updated if engine else 0
+            # a record with bad ids in several fields can match several queries
+            submitted = set()
+            for query, fields in queries:
+                records = getMetadata(client, query, fields, window=max(1, args.window), stats=stats)
+                for obj in records:
+                    #print(obj)
+                    result = checkConversion(obj, rules)
+                    if result['check']:
+                        if engine and engine.isDone(obj['uuid']):
+                            engine.skip(obj['uuid'])
+                            continue
+                        converted.add(obj['uuid'])
+                        if obj.get('associationIds'):
+                            for p in obj['associationIds']:
+                                if p not in projects:
+                                    projects.append(p)
+                        if engine and obj['uuid'] not in submitted:
+                            submitted.add(obj['uuid'])
+                            engine.submit(result['object'])
+            if not engine:
+                break
+            engine.wait()
+            if engine.updated == updated:
+                break
+        stats.report()
+        if engine:
+            engine.close()
+        client.close()
+        # when converting, only the records actually updated are converted
+        print('INFO:', engine.updated if engine else len(converted), 'total records converted.')
         print('INFO:', len(projects), 'projects affected.')
         print(projects)
+        # The watermark only advances once every update is committed, a dry
+        # run leaves it unchanged.
+        if engine and len(engine.failed) > 0:
+            print('WARNING: Watermark not advanced because some updates failed.')
+            sys.exit(1)
+        if engine:
+            saveWatermark(args.watermark, run_start, rules_hash)
+            # the run is complete, so there is nothing left to resume
+            os.remove(args.journal)
@@ -0,0 +1,434 @@
+#
+# HTTP client for the VDJServer and Tapis APIs shared by the conversion
+# scripts and the test driver, so every tool reuses connections and tokens
+# instead of logging in and opening a new connection for each request.
+#
+# ConnectionPool keeps persistent HTTP(S) connections for each host.
+# TokenCache keeps tokens on disk until shortly before they expire.
+# TapisClient combines the two and adds the authorization header.
+# paginate() pages through limit/offset queries.
+#
+# Only the standard library is used, so it runs wherever the scripts do.
+#
+
+import base64
+import collections
+import gzip
+import hashlib
+import http.client
+import json
+import os
+import socket
+import threading
+import time
+import urllib.parse
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Size of reads when streaming a request or response body
+STREAM_CHUNK_SIZE = 65536
+
+# Largest streamed response body kept in memory for the fixture recorder
+RECORD_STREAM_LIMIT = 64 * 1024 * 1024
+
+# Tokens are cached here unless another file is given
+DEFAULT_TOKEN_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'vdjserver', 'tokens.json')
+
+# Tokens are refreshed this many seconds before they expire
+TOKEN_EXPIRY_MARGIN = 60
+
+class HTTPResponseError(Exception):
+    def __init__(self, code, reason):
+        super().__init__(reason)
+        self.code = code
+        self.reason = reason
+
+class ConnectionPool:
+    # A small pool of persistent HTTP(S) connections keyed by scheme, host
+    # and port. At most maxsize connections are open to a host at any time,
+    # and idle connections are kept alive and reused by later requests.
+    def __init__(self, maxsize=4, timeout=60):
+        self.maxsize = max(1, maxsize)
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.slots = {}
+        self.opened = 0
+        self.reused = 0
+        self.recorder = None
+        # called as hook(method, url, status, timing) after every request
+        self.hooks = []
+
+    def _hostKey(self, url):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise HTTPResponseError(None, 'unsupported URL scheme: ' + str(parts.scheme))
+        port = parts.port
+        if port is None:
+            port = 443 if parts.scheme == 'https' else 80
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        return (parts.scheme, parts.hostname, port), path
+
+    def _acquire(self, key):
+        with self.lock:
+            slot = self.slots.get(key)
+            if slot is None:
+                slot = threading.BoundedSemaphore(self.maxsize)
+                self.slots[key] = slot
+        slot.acquire()
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle:
+                self.reused += 1
+                return idle.pop(), True
+            self.opened += 1
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=self.timeout)
+        return conn, False
+
+    def _release(self, key, conn, keep):
+        if keep:
+            with self.lock:
+                self.idle.setdefault(key, []).append(conn)
+        else:
+            conn.close()
+        self.slots[key].release()
+
+    def _connect(self, conn, key, timing):
+        # Open the socket ourselves so that name resolution, TCP connect and
+        # TLS handshake can be timed separately. http.client uses an already
+        # set sock instead of connecting again.
+        scheme, host, port = key
+        start = time.perf_counter()
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        resolved = time.perf_counter()
+        sock = None
+        error = None
+        for family, socktype, proto, canonname, address in addresses:
+            try:
+                sock = socket.socket(family, socktype, proto)
+                sock.settimeout(self.timeout)
+                sock.connect(address)
+                break
+            except OSError as e:
+                error = e
+                if sock is not None:
+                    sock.close()
+                sock = None
+        if sock is None:
+            raise error
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connected = time.perf_counter()
+        if scheme == 'https':
+            sock = conn._context.wrap_socket(sock, server_hostname=host)
+        conn.sock = sock
+        timing['dns'] = resolved - start
+        timing['connect'] = connected - resolved
+        timing['tls'] = time.perf_counter() - connected
+
+    def request(self, method, url, body=None, headers=None, timing=None, reader=None):
+        # Perform the request and return the status, headers and body. A
+        # connection which was closed by the server while idle is retried
+        # once on a new connection. When a timing dict is given, it is filled
+        # with the duration of each phase of the request in seconds. When a
+        # reader is given, the body is passed to reader.feed() in chunks as it
+        # arrives and the reader is returned instead of the body.
+        if timing is None:
+            timing = {}
+        key, path = self._hostKey(url)
+        start = time.perf_counter()
+        for attempt in range(2):
+            conn, reused = self._acquire(key)
+            timing.update({ 'dns': 0.0, 'connect': 0.0, 'tls': 0.0, 'reused': reused })
+            try:
+                if not reused:
+                    self._connect(conn, key, timing)
+                sending = time.perf_counter()
+                conn.request(method, path, body, headers or {})
+                sent = time.perf_counter()
+                response = conn.getresponse()
+                first_byte = time.perf_counter()
+                if reader is None:
+                    data = response.read()
+                    response_bytes = len(data)
+                else:
+                    data = reader
+                    response_bytes = 0
+                    # a copy of the body is kept for the recorder
+                    recorded = [] if self.recorder is not None else None
+                    # read() rather than read1(), as only read() closes the
+                    # response at the end of a Content-Length body
+                    chunk = response.read(STREAM_CHUNK_SIZE)
+                    while chunk:
+                        response_bytes += len(chunk)
+                        reader.feed(chunk)
+                        if recorded is not None and response_bytes <= RECORD_STREAM_LIMIT:
+                            recorded.append(chunk)
+                        chunk = response.read(STREAM_CHUNK_SIZE)
+                    reader.close()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self._release(key, conn, False)
+                if reused and attempt == 0:
+                    continue
+                raise
+            except Exception:
+                self._release(key, conn, False)
+                raise
+            finished = time.perf_counter()
+            # a connection is only reusable once the whole body has been read
+            self._release(key, conn, response.isclosed() and not response.will_close)
+            timing['send'] = sent - sending
+            timing['ttfb'] = first_byte - sent
+            timing['transfer'] = finished - first_byte
+            timing['total'] = finished - start
+            if isinstance(body, bytes):
+                timing['request_bytes'] = len(body)
+            else:
+                timing['request_bytes'] = getattr(body, 'sent', 0)
+            timing['response_bytes'] = response_bytes
+            if self.recorder is not None:
+                if reader is None:
+                    self.recorder.record(method, url, body, response.status, response.headers, data)
+                elif response_bytes <= RECORD_STREAM_LIMIT:
+                    self.recorder.record(method, url, body, response.status, response.headers, b''.join(recorded))
+                else:
+                    print('WARNING: Response of', method, url, 'is too large to record, it cannot be replayed.')
+            for hook in self.hooks:
+                hook(method, url, response.status, timing)
+            return response.status, response.headers, data
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+
+    def printStats(self):
+        print('CONNECTIONS: opened', self.opened, 'reused', self.reused)
+
+def decodeBody(headers, data):
+    # Responses are not decompressed by http.client, so the pool reports
+    # the bytes actually transferred. Returns the parsed JSON, or None for
+    # an empty body.
+    encoding = (headers.get('Content-Encoding') or '').lower()
+    if encoding == 'gzip':
+        data = gzip.decompress(data)
+    elif encoding == 'deflate':
+        data = zlib.decompress(data)
+    if len(data) == 0:
+        return None
+    return json.loads(data.decode(headers.get_content_charset() or 'utf-8'))
+
+class TokenCache:
+    # Tokens kept in a JSON file keyed by a hash of the API URL, user name
+    # and client key, so later runs reuse a token until shortly before it
+    # expires. The file is only readable by its owner and is replaced
+    # atomically.
+    def __init__(self, filename=DEFAULT_TOKEN_CACHE, margin=TOKEN_EXPIRY_MARGIN):
+        self.filename = filename
+        self.margin = margin
+        self.lock = threading.Lock()
+
+    def _key(self, url, username, client_key):
+        return hashlib.sha256((url + '\n' + username + '\n' + (client_key or '')).encode('utf-8')).hexdigest()
+
+    def _load(self):
+        if not os.path.exists(self.filename):
+            return {}
+        try:
+            with open(self.filename, 'r') as fp:
+                return json.load(fp)
+        except ValueError:
+            print('WARNING: Ignoring unreadable token cache', self.filename)
+            return {}
+
+    def _save(self, tokens):
+        directory = os.path.dirname(self.filename)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        partial = self.filename + '.partial'
+        fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(tokens, fp)
+        os.replace(partial, self.filename)
+
+    def get(self, url, username, client_key=None):
+        with self.lock:
+            token = self._load().get(self._key(url, username, client_key))
+        if token is None or token['expires_at'] - self.margin <= time.time():
+            return None
+        return token
+
+    def put(self, url, username, token, client_key=None):
+        # tokens without an expiry are not cached
+        if token.get('expires_at') is None:
+            return
+        with self.lock:
+            tokens = self._load()
+            now = time.time()
+            tokens = { key: value for key, value in tokens.items() if value['expires_at'] > now }
+            tokens[self._key(url, username, client_key)] = token
+            self._save(tokens)
+
+    def remove(self, url, username, client_key=None):
+        with self.lock:
+            tokens = self._load()
+            if tokens.pop(self._key(url, username, client_key), None) is not None:
+                self._save(tokens)
+
+class TapisClient:
+    # Requests to one API over a connection pool. After authenticate(),
+    # requests carry the bearer token, which is read from the token cache
+    # when possible and renewed with the stored credentials before it
+    # expires. A cached token which the API rejects, for example because
+    # it belongs to another password, is replaced by logging in again.
+    def __init__(self, base_url, pool=None, token_cache=None, pool_size=4):
+        self.base_url = base_url.rstrip('/')
+        self.pool = pool if pool is not None else ConnectionPool(pool_size)
+        self.token_cache = token_cache
+        self.credentials = None
+        self.token = None
+        self.token_cached = False
+        self.margin = token_cache.margin if token_cache else TOKEN_EXPIRY_MARGIN
+        self.lock = threading.Lock()
+        self.logins = 0
+
+    def url(self, path):
+        if path.startswith('http://') or path.startswith('https://'):
+            return path
+        return self.base_url + path
+
+    def _login(self, username, password, client_key, client_secret):
+        # The Tapis gateway takes a password grant form with the client
+        # key and secret, the VDJServer API takes JSON.
+        if client_key:
+            body = urllib.parse.urlencode({
+                'grant_type': 'password',
+                'scope': 'PRODUCTION',
+                'username': username,
+                'password': password
+            }).encode('utf-8')
+            basic = base64.b64encode((client_key + ':' + client_secret).encode('utf-8')).decode('ascii')
+            headers = { 'Content-Type': 'application/x-www-form-urlencoded', 'Authorization': 'Basic ' + basic }
+        else:
+            body = json.dumps({ 'username': username, 'password': password }).encode('utf-8')
+            headers = { 'Content-Type': 'application/json' }
+        headers['Accept'] = 'application/json'
+        status, response_headers, data = self.pool.request('POST', self.url('/token'), body, headers)
+        if status != 200:
+            raise HTTPResponseError(status, 'login failed with status ' + str(status))
+        token = decodeBody(response_headers, data)
+        if 'access_token' not in token and isinstance(token.get('result'), dict):
+            token = token['result']
+        if isinstance(token.get('expires_in'), (int, float)) or str(token.get('expires_in', '')).isdigit():
+            token['expires_at'] = time.time() + int(token['expires_in'])
+        self.logins += 1
+        return token
+
+    def _expiring(self, token):
+        return token.get('expires_at') is not None and token['expires_at'] - self.margin <= time.time()
+
+    def authenticate(self, username, password, client_key=None, client_secret=None):
+        self.credentials = (username, password, client_key, client_secret)
+        self.token = None
+        return self.getToken()
+
+    def getToken(self):
+        with self.lock:
+            if self.token is not None and not self._expiring(self.token):
+                return self.token
+            username, client_key = self.credentials[0], self.credentials[2]
+            token = None
+            if self.token_cache is not None:
+                token = self.token_cache.get(self.base_url, username, client_key)
+            self.token_cached = token is not None
+            if token is None:
+                token = self._login(*self.credentials)
+                if self.token_cache is not None:
+                    self.token_cache.put(self.base_url, username, token, client_key)
+            self.token = token
+            return token
+
+    def _rejected(self, token):
+        # Log in again when a token from the cache was rejected. Returns
+        # True if the request should be sent again with the new token.
+        with self.lock:
+            if self.token is not token:
+                # another thread has already replaced it
+                return True
+            if not self.token_cached:
+                return False
+            print('INFO: Cached token was rejected, logging in again.')
+            username, client_key = self.credentials[0], self.credentials[2]
+            self.token_cache.remove(self.base_url, username, client_key)
+            self.token = None
+            self.token_cached = False
+        self.getToken()
+        return True
+
+    def request(self, method, path, body=None, headers=None, timing=None, reader=None):
+        # Dict and list bodies are sent as JSON. Returns the status, headers
+        # and undecoded body from ConnectionPool.request().
+        headers = dict(headers or {})
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode('utf-8')
+            headers.setdefault('Content-Type', 'application/json')
+        if self.credentials is None:
+            return self.pool.request(method, self.url(path), body, headers, timing, reader)
+        token = self.getToken()
+        headers['Authorization'] = 'Bearer ' + token['access_token']
+        response = self.pool.request(method, self.url(path), body, headers, timing, reader)
+        if response[0] == 401 and reader is None and isinstance(body, (type(None), str, bytes)) and self._rejected(token):
+            headers['Authorization'] = 'Bearer ' + self.getToken()['access_token']
+            response = self.pool.request(method, self.url(path), body, headers, timing, reader)
+        return response
+
+    def json(self, method, path, body=None, headers=None, timing=None):
+        # Request a compressed JSON response and return the status, headers
+        # and parsed body. Error responses are returned undecoded, as the
+        # gateway answers with HTML pages, so callers can check the status.
+        headers = dict(headers or {})
+        headers.setdefault('Accept', 'application/json')
+        headers.setdefault('Accept-Encoding', 'gzip')
+        status, response_headers, data = self.request(method, path, body, headers, timing)
+        if status < 200 or status >= 300:
+            return status, response_headers, data
+        return status, response_headers, decodeBody(response_headers, data)
+
+    def close(self):
+        self.pool.close()
+
+# Yield the records of a limit/offset query page by page, stopping at the
+# first empty page. fetch(limit, offset) returns the records of one page.
+#
+# Pages are prefetched concurrently with at most window requests in flight,
+# and the records are yielded in order as soon as their page arrives. This
+# lets processing start on the first page while memory only holds the
+# pages in the window.
+def paginate(fetch, limit=100, window=1):
+    window = max(1, window)
+    offset = 0
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=window) as executor:
+        for i in range(window):
+            pending.append(executor.submit(fetch, limit, offset))
+            offset += limit
+        done = False
+        while len(pending) > 0:
+            page = pending.popleft().result()
+            if done:
+                # requests sent past the last page
+                continue
+            if len(page) > 0:
+                pending.append(executor.submit(fetch, limit, offset))
+                offset += limit
+                for obj in page:
+                    yield obj
+            else:
+                done = True
@@ -0,0 +1,168 @@
+from __future__ import print_function
+import json
+import argparse
+import os
+import time
+import yaml
+import meta_dump
+
+# Convert a Meta JSON dump into a compact column cache so that repeated
+# questions about the dump do not parse the JSON again. The cache is a
+# SQLite database, by default the dump file name with .cache added, which
+# is read through a memory map.
+#
+# For every record the cache holds uuid, name, owner, created,
+# lastUpdated, associationIds and the byte offset of the record in the
+# dump. Names, owners and the values of chosen value fields are dictionary
+# encoded, each distinct string is stored once and the columns hold its
+# id. The count of each top level value field for every name is also kept,
+# which answers list_fields.py queries.
+#
+# The dump is scanned with a pool of processes like profile_dump.py.
+
+# Bytes of the cache file mapped into memory when reading
+CACHE_MMAP_SIZE = 1 << 34
+
+# Rows inserted into the cache in each transaction
+INSERT_BATCH_SIZE = 10000
+
+def cacheFilename(filename):
+    return filename + '.cache'
+
+# Scalar values at a dotted field path, lists along the path are expanded
+def fieldValues(value, path):
+    if isinstance(value, list):
+        for item in value:
+            yield from fieldValues(item, path)
+        return
+    if len(path) == 0:
+        if not isinstance(value, dict):
+            yield value
+        return
+    if isinstance(value, dict) and path[0] in value:
+        yield from fieldValues(value[path[0]], path[1:])
+
+# The id of the ontology object at each rule path, as used by
+# fix_species.checkConversion
+def ruleFields(filename):
+    with open(filename, 'r') as fp:
+        rule_list = yaml.safe_load(fp)
+    return sorted(set(rule['path'] + '.id' for rule in rule_list))
+
+def cacheRange(filename, start, end, fields):
+    paths = [tuple(field.split('.')) for field in fields]
+    rows = []
+    errors = 0
+    for offset, line in meta_dump.readLines(filename, start, end):
+        if not line.strip():
+            continue
+        try:
+            for item, position, length in meta_dump.recordSpans(line):
+                if not isinstance(item, dict):
+                    continue
+                value = item.get('value')
+                keys = list(value.keys()) if isinstance(value, dict) else []
+                values = []
+                for i, path in enumerate(paths):
+                    for v in fieldValues(value, path):
+                        values.append((i, json.dumps(v)))
+                rows.append((offset + position, length, item.get('uuid'), item.get('name'), item.get('owner'),
+                             item.get('created'), item.get('lastUpdated'), json.dumps(item.get('associationIds') or []),
+                             keys, values))
+        except ValueError:
+            errors += 1
+    return rows, errors
+
+class Dictionary:
+    # Assigns an id to each distinct string, new strings are inserted in
+    # batches along with the rows using them
+    def __init__(self):
+        self.ids = {}
+        self.new = []
+
+    def id(self, value):
+        if value is None:
+            return None
+        i = self.ids.get(value)
+        if i is None:
+            i = len(self.ids) + 1
+            self.ids[value] = i
+            self.new.append((i, value))
+        return i
+
+    def flush(self, db):
+        db.executemany('INSERT INTO strings VALUES (?, ?)', self.new)
+        self.new = []
+
+def buildCache(filename, cache_file, fields, jobs):
+    db = meta_dump.createDatabase(filename, cache_file, [
+        'CREATE TABLE strings (id INTEGER PRIMARY KEY, value TEXT)',
+        'CREATE TABLE records (id INTEGER PRIMARY KEY, offset INTEGER, length INTEGER, uuid TEXT, name INTEGER, owner INTEGER, created TEXT, last_updated TEXT, associations TEXT)',
+        'CREATE TABLE fields (id INTEGER PRIMARY KEY, path TEXT)',
+        'CREATE TABLE field_values (record INTEGER, field INTEGER, value INTEGER)',
+        'CREATE TABLE name_fields (name INTEGER, field TEXT, count INTEGER)'])
+    db.executemany('INSERT INTO fields VALUES (?, ?)', list(enumerate(fields)))
+
+    strings = Dictionary()
+    name_fields = {}
+    record_id = 0
+    errors = 0
+    for rows, range_errors in meta_dump.scanRanges(filename, jobs, cacheRange, fields):
+        errors += range_errors
+        for i in range(0, len(rows), INSERT_BATCH_SIZE):
+            records = []
+            values = []
+            for offset, length, uuid, name, owner, created, last_updated, associations, keys, field_values in rows[i:i + INSERT_BATCH_SIZE]:
+                record_id += 1
+                name_id = strings.id(name)
+                records.append((record_id, offset, length, uuid, name_id, strings.id(owner), created, last_updated, associations))
+                for field, v in field_values:
+                    values.append((record_id, field, strings.id(v)))
+                counts = name_fields.setdefault(name_id, {})
+                for key in keys:
+                    counts[key] = counts.get(key, 0) + 1
+            strings.flush(db)
+            db.executemany('INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', records)
+            db.executemany('INSERT INTO field_values VALUES (?, ?, ?)', values)
+        db.commit()
+
+    db.executemany('INSERT INTO name_fields VALUES (?, ?, ?)',
+        [(name_id, key, count) for name_id, counts in name_fields.items() for key, count in counts.items()])
+    meta_dump.finishDatabase(db, cache_file, [
+        'CREATE INDEX strings_value ON strings (value)',
+        'CREATE INDEX records_name ON records (name)',
+        'CREATE INDEX records_uuid ON records (uuid)',
+        'CREATE INDEX field_values_record ON field_values (record)',
+        'CREATE INDEX field_values_field ON field_values (field, value)'], vacuum=True)
+    return record_id, errors
+
+# Open the cache of a dump, or None if it is missing or out of date
+def openCache(filename, cache_file=None):
+    if cache_file is None:
+        cache_file = cacheFilename(filename)
+    db = meta_dump.openDatabase(filename, cache_file, 'cache', 'cache_dump.py')
+    if db is not None:
+        db.execute('PRAGMA mmap_size = ' + str(CACHE_MMAP_SIZE))
+    return db
+
+if (__name__=="__main__"):
+    parser = argparse.ArgumentParser(description='Build a column cache of Meta JSON file.')
+    parser.add_argument('json_file', type=str, help='Input JSON file name')
+    parser.add_argument('-o', '--output', type=str, help='Cache file name, default is the JSON file name with .cache added')
+    parser.add_argument('-f', '--field', type=str, action='append', default=[], help='Dotted value field path to cache, may be repeated')
+    parser.add_argument('-r', '--rules', type=str, action='append', default=[], help='Also cache the fields used by this fix_species.py rules file, may be repeated')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Number of worker processes')
+    args = parser.parse_args()
+
+    fields = list(args.field)
+    for rules_file in args.rules:
+        fields.extend(ruleFields(rules_file))
+    fields = sorted(set(fields))
+
+    cache_file = args.output if args.output else cacheFilename(args.json_file)
+    start = time.monotonic()
+    total, errors = buildCache(args.json_file, cache_file, fields, max(1, args.jobs))
+    elapsed = time.monotonic() - start
+    print(total, 'records cached in', cache_file, 'with', errors, 'lines not cached due to errors')
+    print('cached fields:', ', '.join(fields))
+    print('%.1f seconds' % elapsed)
@@ -0,0 +1,133 @@
+#
+# Streaming statistics for the fields of meta record values.
+#
+# For every nested field path this keeps a count, a histogram of value
+# types, an approximate count of distinct values and a few sample values.
+# Memory is fixed for each path however many records are read, because
+# distinct values are estimated with a HyperLogLog sketch instead of being
+# kept in a set.
+#
+
+import hashlib
+import math
+
+# 2^12 registers give a standard error of about 1.6%
+HLL_PRECISION = 12
+
+# Sample values kept for each path
+MAX_SAMPLES = 5
+
+# Sample strings are cut to this length
+MAX_SAMPLE_LENGTH = 80
+
+class HyperLogLog:
+    # Hashes are computed with blake2b rather than hash(), which differs
+    # between processes, so sketches from separate processes can be merged.
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = bytearray(self.m)
+
+    def add(self, value):
+        x = int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+        j = x >> (64 - self.precision)
+        w = (x << self.precision) & 0xFFFFFFFFFFFFFFFF
+        rank = 64 - w.bit_length() + 1 if w else 64 - self.precision + 1
+        if rank > self.registers[j]:
+            self.registers[j] = rank
+
+    def merge(self, other):
+        for j in range(self.m):
+            if other.registers[j] > self.registers[j]:
+                self.registers[j] = other.registers[j]
+
+    def estimate(self):
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.m and zeros > 0:
+            # small range correction
+            estimate = self.m * math.log(self.m / zeros)
+        return int(round(estimate))
+
+def typeName(value):
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, int):
+        return 'int'
+    if isinstance(value, float):
+        return 'float'
+    if isinstance(value, str):
+        return 'str'
+    if isinstance(value, dict):
+        return 'dict'
+    if isinstance(value, list):
+        return 'list'
+    return type(value).__name__
+
+class PathStats:
+    def __init__(self):
+        self.count = 0
+        self.types = {}
+        self.distinct = HyperLogLog()
+        self.samples = []
+
+    def add(self, value, type_name):
+        self.count += 1
+        self.types[type_name] = self.types.get(type_name, 0) + 1
+        if type_name in ('dict', 'list'):
+            return
+        # prefix with the type so 1 and '1' are distinct
+        key = type_name + ':' + str(value)
+        self.distinct.add(key)
+        if len(self.samples) < MAX_SAMPLES:
+            if isinstance(value, str) and len(value) > MAX_SAMPLE_LENGTH:
+                value = value[:MAX_SAMPLE_LENGTH] + '...'
+            if value not in self.samples:
+                self.samples.append(value)
+
+    def toJSON(self):
+        return {
+            'count': self.count,
+            'types': dict(sorted(self.types.items(), key=lambda t: -t[1])),
+            'distinct': self.distinct.estimate(),
+            'samples': self.samples
+        }
+
+class FieldStats:
+    # Nested fields are named with dots, like species.id, and the entries
+    # of lists with [], like diagnosis[].disease_diagnosis.id. Fields deeper
+    # than max_depth are counted at max_depth without going further.
+    def __init__(self, max_depth=8):
+        self.max_depth = max_depth
+        self.paths = {}
+        self.records = 0
+
+    def _add(self, path, value, depth):
+        type_name = typeName(value)
+        stats = self.paths.get(path)
+        if stats is None:
+            stats = self.paths[path] = PathStats()
+        stats.add(value, type_name)
+        if depth >= self.max_depth:
+            return
+        if type_name == 'dict':
+            for key, child in value.items():
+                self._add(path + '.' + key if path else key, child, depth + 1)
+        elif type_name == 'list':
+            for child in value:
+                self._add(path + '[]', child, depth + 1)
+
+    def addValue(self, value):
+        # the top level of a record value
+        self.records += 1
+        if not isinstance(value, dict):
+            self._add('', value, 0)
+            return
+        for key, child in value.items():
+            self._add(key, child, 1)
+
+    def toJSON(self):
+        return { path: self.paths[path].toJSON() for path in sorted(self.paths) }
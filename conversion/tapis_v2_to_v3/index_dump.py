@@ -0,0 +1,106 @@
+from __future__ import print_function
+import json
+import argparse
+import mmap
+import os
+import time
+import meta_dump
+
+# Build an index of a Meta JSON dump with the byte offset and length of
+# every record, keyed by uuid, name and associationIds. With the index,
+# records are read directly from a memory map of the dump instead of
+# parsing the whole file. The index is a SQLite database, by default the
+# dump file name with .index added.
+#
+# The dump is scanned with a pool of processes like profile_dump.py.
+
+# Rows inserted into the index in each transaction
+INSERT_BATCH_SIZE = 10000
+
+def indexFilename(filename):
+    return filename + '.index'
+
+def indexRange(filename, start, end):
+    records = []
+    associations = []
+    errors = 0
+    for offset, line in meta_dump.readLines(filename, start, end):
+        if not line.strip():
+            continue
+        try:
+            for item, position, length in meta_dump.recordSpans(line):
+                if not isinstance(item, dict):
+                    continue
+                record_offset = offset + position
+                records.append((record_offset, length, item.get('uuid'), item.get('name')))
+                for association in item.get('associationIds') or []:
+                    associations.append((association, record_offset))
+        except ValueError:
+            errors += 1
+    return records, associations, errors
+
+def buildIndex(filename, index_file, jobs):
+    db = meta_dump.createDatabase(filename, index_file, [
+        'CREATE TABLE records (offset INTEGER PRIMARY KEY, length INTEGER, uuid TEXT, name TEXT)',
+        'CREATE TABLE associations (association TEXT, offset INTEGER)'])
+    total = 0
+    errors = 0
+    for records, associations, range_errors in meta_dump.scanRanges(filename, jobs, indexRange):
+        for i in range(0, len(records), INSERT_BATCH_SIZE):
+            db.executemany('INSERT INTO records VALUES (?, ?, ?, ?)', records[i:i + INSERT_BATCH_SIZE])
+        for i in range(0, len(associations), INSERT_BATCH_SIZE):
+            db.executemany('INSERT INTO associations VALUES (?, ?)', associations[i:i + INSERT_BATCH_SIZE])
+        db.commit()
+        total += len(records)
+        errors += range_errors
+    meta_dump.finishDatabase(db, index_file, [
+        'CREATE INDEX records_uuid ON records (uuid)',
+        'CREATE INDEX records_name ON records (name)',
+        'CREATE INDEX associations_association ON associations (association)'])
+    return total, errors
+
+# Open the index of a dump, or None if it is missing or out of date
+def openIndex(filename, index_file=None):
+    if index_file is None:
+        index_file = indexFilename(filename)
+    return meta_dump.openDatabase(filename, index_file, 'index', 'index_dump.py')
+
+# Offsets and lengths of the records matching all the given keys, in file order
+def findRecords(db, uuids=None, names=None, associations=None):
+    query = 'SELECT offset, length FROM records'
+    conditions = []
+    params = []
+    if uuids:
+        conditions.append('uuid IN (' + ','.join('?' * len(uuids)) + ')')
+        params.extend(uuids)
+    if names:
+        conditions.append('name IN (' + ','.join('?' * len(names)) + ')')
+        params.extend(names)
+    if associations:
+        conditions.append('offset IN (SELECT offset FROM associations WHERE association IN (' + ','.join('?' * len(associations)) + '))')
+        params.extend(associations)
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY offset'
+    return db.execute(query, params)
+
+# Yield the records matching the keys, read through a memory map of the dump
+def readIndexed(filename, db, uuids=None, names=None, associations=None):
+    with open(filename, 'rb') as fp:
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for offset, length in findRecords(db, uuids, names, associations):
+                yield json.loads(mm[offset:offset + length])
+
+if (__name__=="__main__"):
+    parser = argparse.ArgumentParser(description='Index records in Meta JSON file by uuid, name and associationIds.')
+    parser.add_argument('json_file', type=str, help='Input JSON file name')
+    parser.add_argument('-i', '--index', type=str, help='Index file name, default is the JSON file name with .index added')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Number of worker processes')
+    args = parser.parse_args()
+
+    index_file = args.index if args.index else indexFilename(args.json_file)
+    start = time.monotonic()
+    total, errors = buildIndex(args.json_file, index_file, max(1, args.jobs))
+    elapsed = time.monotonic() - start
+    print(total, 'records indexed in', index_file, 'with', errors, 'lines not indexed due to errors')
+    print('%.1f seconds' % elapsed)
@@ -3,33 +3,57 @@ import json
 import argparse
 import os
 import sys
+import index_dump
+import field_stats
 
-if (__name__=="__main__"):
-    parser = argparse.ArgumentParser(description='List fields for name in Meta JSON file.')
-    parser.add_argument('json_file', type=str, help='Input JSON file name')
-    parser.add_argument('object_name', type=str, help='Object name')
-    args = parser.parse_args()
-
-    names = {}
-    with open(args.json_file, 'r') as fp:
+# Read every record in the file
+def readDump(filename):
+    with open(filename, 'r') as fp:
         line = fp.readline()
         while line:
             try:
                 obj = json.loads(line)
                 for item in obj:
-                    if isinstance(item, dict) and 'name' in item:
-                        if item['name'] == args.object_name:
-                            for field in item['value'].keys():
-                                if names.get(field) is None:
-                                    names[field] = 1
-                                else:
-                                    names[field] += 1
-                    else:
-                        print("Item is not a dictionary or 'name' key not found")
+                    yield item
             except json.JSONDecodeError as e:
                 print(f"Error decoding JSON: {e}")
 
             line = fp.readline()
 
-        print(json.dumps(names, indent=2))
-        print(len(names.keys()))
+if (__name__=="__main__"):
+    parser = argparse.ArgumentParser(description='List fields for name in Meta JSON file.')
+    parser.add_argument('json_file', type=str, help='Input JSON file name')
+    parser.add_argument('object_name', type=str, help='Object name')
+    parser.add_argument('-i', '--index', action='store_true', help='Only read the records for the name using the index from index_dump.py')
+    parser.add_argument('-s', '--stats', action='store_true', help='Report the value types, approximate distinct values and samples of every nested field')
+    parser.add_argument('--max-depth', type=int, default=8, help='Maximum depth of nested fields for --stats')
+    args = parser.parse_args()
+
+    if args.index:
+        db = index_dump.openIndex(args.json_file)
+        if db is None:
+            sys.exit(1)
+        items = index_dump.readIndexed(args.json_file, db, names=[args.object_name])
+    else:
+        items = readDump(args.json_file)
+
+    names = {}
+    stats = field_stats.FieldStats(args.max_depth)
+    for item in items:
+        if isinstance(item, dict) and 'name' in item:
+            if item['name'] == args.object_name:
+                if args.stats:
+                    stats.addValue(item['value'])
+                    continue
+                for field in item['value'].keys():
+                    if names.get(field) is None:
+                        names[field] = 1
+                    else:
+                        names[field] += 1
+        else:
+            print("Item is not a dictionary or 'name' key not found")
+
+    if args.stats:
+        names = stats.toJSON()
+    print(json.dumps(names, indent=2))
+    print(len(names.keys()))
@@ -0,0 +1,28 @@
+from __future__ import print_function
+import json
+import argparse
+import sys
+import index_dump
+
+# Read records from a Meta JSON dump by uuid, name or associationIds using
+# the index built by index_dump.py. Only the matching records are read.
+
+if (__name__=="__main__"):
+    parser = argparse.ArgumentParser(description='Look up records in indexed Meta JSON file.')
+    parser.add_argument('json_file', type=str, help='Input JSON file name')
+    parser.add_argument('-i', '--index', type=str, help='Index file name, default is the JSON file name with .index added')
+    parser.add_argument('-u', '--uuid', type=str, action='append', help='Record uuid, may be repeated')
+    parser.add_argument('-n', '--name', type=str, action='append', help='Object name, may be repeated')
+    parser.add_argument('-a', '--association', type=str, action='append', help='Associated uuid, may be repeated')
+    parser.add_argument('-c', '--count', action='store_true', help='Only print the number of matching records')
+    args = parser.parse_args()
+
+    db = index_dump.openIndex(args.json_file, args.index)
+    if db is None:
+        sys.exit(1)
+    if args.count:
+        print(sum(1 for r in index_dump.findRecords(db, args.uuid, args.name, args.association)))
+    else:
+        # one record per line
+        for item in index_dump.readIndexed(args.json_file, db, args.uuid, args.name, args.association):
+            print(json.dumps(item))
@@ -0,0 +1,180 @@
+#
+# Reading Tapis V2 Meta JSON dumps.
+#
+# Each line of a dump is a JSON array of meta records. A dump is split
+# into byte ranges which start and end on line boundaries, so the ranges
+# can be parsed independently by separate processes. A line belongs to
+# the range in which it starts.
+#
+
+import json
+import os
+import re
+import sqlite3
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+# Ranges per worker, so a slow range does not hold up the whole pool
+RANGES_PER_WORKER = 4
+
+# Whitespace between the records of a line
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+# Split the file into about the given number of line-aligned byte ranges
+def splitRanges(filename, parts):
+    size = os.path.getsize(filename)
+    parts = max(1, min(parts, size))
+    bounds = [0]
+    with open(filename, 'rb') as fp:
+        for i in range(1, parts):
+            position = size * i // parts
+            if position <= bounds[-1]:
+                continue
+            # move forward to the start of the next line
+            fp.seek(position - 1)
+            fp.readline()
+            position = fp.tell()
+            if position >= size:
+                break
+            if position > bounds[-1]:
+                bounds.append(position)
+    bounds.append(size)
+    return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1) if bounds[i + 1] > bounds[i]]
+
+# Yield the start and end offset and the data of chunks of whole lines
+def readChunks(filename, start, chunk_size):
+    with open(filename, 'rb') as fp:
+        fp.seek(start)
+        offset = start
+        while True:
+            data = fp.read(chunk_size)
+            if not data:
+                break
+            # finish the last line of the chunk
+            if not data.endswith(b'\n'):
+                data += fp.readline()
+            yield offset, offset + len(data), data
+            offset += len(data)
+
+# Yield the byte offset and text of each line in the range
+def readLines(filename, start=0, end=None):
+    with open(filename, 'rb') as fp:
+        fp.seek(start)
+        offset = start
+        while end is None or offset < end:
+            line = fp.readline()
+            if not line:
+                break
+            yield offset, line
+            offset += len(line)
+
+# Yield the byte offset of its line and each meta record in the range.
+# Lines which are not valid JSON are passed to on_error(offset, error).
+def readRecords(filename, start=0, end=None, on_error=None):
+    for offset, line in readLines(filename, start, end):
+        if not line.strip():
+            continue
+        try:
+            obj = json.loads(line)
+        except ValueError as e:
+            if on_error:
+                on_error(offset, e)
+            continue
+        # a line may also hold a single record
+        if not isinstance(obj, list):
+            obj = [obj]
+        for item in obj:
+            yield offset, item
+
+# Yield the record, and its byte offset and length within the line, for
+# each record of a line holding a JSON array. Records are decoded one at a
+# time so their positions are known. Raises ValueError on invalid JSON.
+def recordSpans(line):
+    text = line.decode('utf-8')
+    decoder = json.JSONDecoder()
+    index = WHITESPACE.match(text, 0).end()
+    if not text.startswith('[', index):
+        # a line may also hold a single record
+        obj, end = decoder.raw_decode(text, index)
+        yield obj, len(text[:index].encode('utf-8')), len(text[index:end].encode('utf-8'))
+        return
+    index = WHITESPACE.match(text, index + 1).end()
+    if text.startswith(']', index):
+        return
+    # byte position kept alongside the character position, which differ
+    # when the line has multi-byte characters
+    byte_index = len(text[:index].encode('utf-8'))
+    while True:
+        obj, end = decoder.raw_decode(text, index)
+        length = len(text[index:end].encode('utf-8'))
+        yield obj, byte_index, length
+        next_index = WHITESPACE.match(text, end).end()
+        if text.startswith(']', next_index):
+            return
+        if not text.startswith(',', next_index):
+            raise ValueError('expecting , delimiter at character ' + str(next_index))
+        index = WHITESPACE.match(text, next_index + 1).end()
+        byte_index += length + len(text[end:index].encode('utf-8'))
+
+# Yield function(filename, start, end, *args) for each range of the dump in
+# file order, run on a pool of processes
+def scanRanges(filename, jobs, function, *args):
+    ranges = splitRanges(filename, jobs * RANGES_PER_WORKER)
+    if jobs == 1:
+        for start, end in ranges:
+            yield function(filename, start, end, *args)
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(function, filename, start, end, *args) for start, end in ranges]
+        for future in futures:
+            yield future.result()
+
+#
+# SQLite databases built from a dump, like the index and the column cache,
+# have a dump table with the size and modification time of the dump, so
+# they are not used once the dump has changed.
+#
+
+# Create the database with the given tables as a partial file, which
+# finishDatabase() renames, so an interrupted build does not leave a
+# partial database
+def createDatabase(filename, db_file, tables):
+    partial = db_file + '.partial'
+    if os.path.exists(partial):
+        os.remove(partial)
+    db = sqlite3.connect(partial)
+    db.execute('PRAGMA journal_mode = OFF')
+    db.execute('PRAGMA synchronous = OFF')
+    db.execute('CREATE TABLE dump (filename TEXT, size INTEGER, mtime REAL)')
+    for table in tables:
+        db.execute(table)
+    stat = os.stat(filename)
+    db.execute('INSERT INTO dump VALUES (?, ?, ?)', (os.path.abspath(filename), stat.st_size, stat.st_mtime))
+    return db
+
+def finishDatabase(db, db_file, indexes, vacuum=False):
+    # indexes are faster to create once all rows are inserted
+    for index in indexes:
+        db.execute(index)
+    db.commit()
+    if vacuum:
+        db.execute('VACUUM')
+    db.close()
+    os.replace(db_file + '.partial', db_file)
+
+# Open the database of a dump, checking it was built from the same file.
+# kind and script name the database and the script which builds it in the
+# error messages.
+def openDatabase(filename, db_file, kind, script):
+    if not os.path.exists(db_file):
+        print('ERROR: No', kind, db_file, 'run', script, 'first.', file=sys.stderr)
+        return None
+    db = sqlite3.connect(db_file)
+    size, mtime = db.execute('SELECT size, mtime FROM dump').fetchone()
+    stat = os.stat(filename)
+    # the offsets of a stale database point into the middle of other records
+    if size != stat.st_size or mtime != stat.st_mtime:
+        print('ERROR: Dump', filename, 'has changed since the', kind, 'was built, rebuild it with ' + script + '.', file=sys.stderr)
+        db.close()
+        return None
+    return db
@@ -0,0 +1,390 @@
+from __future__ import print_function
+import json
+import argparse
+import collections
+import http.client
+import os
+import sqlite3
+import sys
+import time
+import yaml
+from concurrent.futures import ProcessPoolExecutor
+import meta_dump
+# the API client is shared with the other conversion scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import tapis_client
+
+# Migrate the meta records in a V2 Meta JSON dump to V3.
+#
+# The dump is read as a stream of chunks of whole lines. Each chunk is
+# transformed on a pool of processes using the rules for each record name
+# in migration_rules.yaml, and the results are written in order to a sink
+# in batches. Only a bounded number of chunks are in flight, so reading
+# waits for the transforms and the sink instead of filling memory.
+#
+# The records of a chunk are written in batches of one V3 name, and a
+# checkpoint is saved after each batch with the byte range of the chunk and
+# the number of its batches written. Running the same command again reads
+# the chunk again and resumes with the next batch.
+
+# Fields of the record kept in V3, other V2 fields like _links are dropped
+RECORD_FIELDS = ['uuid', 'owner', 'associationIds', 'name', 'value', 'created', 'lastUpdated']
+
+RULE_KEYS = ['name', 'target', 'drop', 'rename', 'remove']
+
+# HTTP status codes which are retried by the API sink
+RETRY_STATUS = [429, 500, 502, 503, 504]
+
+# Seconds between progress reports
+REPORT_INTERVAL = 10
+
+def loadRules(filename):
+    with open(filename, 'r') as fp:
+        entries = yaml.safe_load(fp) or []
+    rules = {}
+    for entry in entries:
+        unknown = [key for key in entry if key not in RULE_KEYS]
+        if unknown:
+            raise ValueError('rule for ' + str(entry.get('name')) + ' has unknown keys: ' + ', '.join(unknown))
+        if entry.get('name') is None:
+            raise ValueError('rule is missing name: ' + json.dumps(entry))
+        if entry['name'] in rules:
+            raise ValueError('more than one rule for ' + entry['name'])
+        if not entry.get('drop') and entry.get('target') is None:
+            raise ValueError('rule for ' + entry['name'] + ' needs a target or drop')
+        rules[entry['name']] = {
+            'target': entry.get('target'),
+            'drop': bool(entry.get('drop')),
+            'rename': entry.get('rename') or {},
+            'remove': set(entry.get('remove') or [])
+        }
+    return rules
+
+def transformRecord(item, rule):
+    record = { field: item[field] for field in RECORD_FIELDS if field in item }
+    record['name'] = rule['target']
+    value = item.get('value')
+    if isinstance(value, dict) and (rule['rename'] or rule['remove']):
+        value = { rule['rename'].get(key, key): v for key, v in value.items() if key not in rule['remove'] }
+        record['value'] = value
+    return record
+
+# rules for the transform processes, set by initWorker()
+worker_rules = None
+
+def initWorker(rules):
+    global worker_rules
+    worker_rules = rules
+
+# Transform the lines of one chunk. The records are returned as JSON text
+# so they are only serialized once, here in the worker.
+def transformChunk(data):
+    records = []
+    counts = collections.Counter()
+    for line in data.splitlines():
+        if not line.strip():
+            continue
+        try:
+            obj = json.loads(line)
+        except ValueError:
+            counts['error json'] += 1
+            continue
+        if not isinstance(obj, list):
+            obj = [obj]
+        for item in obj:
+            if not isinstance(item, dict) or 'name' not in item:
+                counts['error no_name'] += 1
+                continue
+            rule = worker_rules.get(item['name'])
+            if rule is None:
+                counts['unmapped ' + item['name']] += 1
+                continue
+            if rule['drop']:
+                counts['dropped ' + item['name']] += 1
+                continue
+            record = transformRecord(item, rule)
+            records.append((record['name'], record.get('uuid'), json.dumps(record)))
+            counts['migrated ' + item['name'] + ' -> ' + record['name']] += 1
+    return records, counts
+
+class FileSink:
+    # JSON Lines file with one V3 record per line. On resume the file is
+    # truncated to its size at the checkpoint, so nothing is written twice.
+    def __init__(self, filename):
+        self.filename = filename
+        self.fp = None
+
+    def open(self, state):
+        if state:
+            self.fp = open(self.filename, 'r+b')
+            self.fp.truncate(state['size'])
+            self.fp.seek(state['size'])
+        else:
+            self.fp = open(self.filename, 'wb')
+
+    def write(self, records):
+        self.fp.write(''.join(text + '\n' for target, uuid, text in records).encode('utf-8'))
+
+    def flush(self):
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+
+    def state(self):
+        return { 'size': self.fp.tell() }
+
+    def close(self):
+        self.fp.close()
+
+class SQLiteSink:
+    # Local stand-in for the MongoDB database with a collection for each V3
+    # name. Records are replaced by uuid, so writes repeated after a resume
+    # do not create duplicates.
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = None
+
+    def open(self, state):
+        self.db = sqlite3.connect(self.filename)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS documents (collection TEXT, uuid TEXT, document TEXT, PRIMARY KEY (collection, uuid))')
+
+    def write(self, records):
+        self.db.executemany('INSERT OR REPLACE INTO documents VALUES (?, ?, ?)', records)
+
+    def flush(self):
+        self.db.commit()
+
+    def state(self):
+        return {}
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+class APISink:
+    # Bulk inserts to the Tapis V3 meta API. The records of each V3 name are
+    # POSTed as a JSON array to the collection of that name in the database
+    # at the URL.
+    def __init__(self, url, token, retries=5, backoff=1.0):
+        self.url = url
+        self.token = token
+        self.retries = retries
+        self.backoff = backoff
+        self.pool = tapis_client.ConnectionPool(1)
+
+    def open(self, state):
+        pass
+
+    def write(self, records):
+        by_target = collections.OrderedDict()
+        for target, uuid, text in records:
+            by_target.setdefault(target, []).append(text)
+        for target, texts in by_target.items():
+            self.insert(self.url.rstrip('/') + '/' + target, ('[' + ','.join(texts) + ']').encode('utf-8'))
+
+    def insert(self, url, body):
+        headers = { 'Content-Type': 'application/json', 'Accept': 'application/json', 'X-Tapis-Token': self.token }
+        for attempt in range(self.retries + 1):
+            delay = self.backoff * (2 ** attempt)
+            try:
+                status, response_headers, data = self.pool.request('POST', url, body, headers)
+            except (OSError, http.client.HTTPException) as e:
+                if attempt == self.retries:
+                    raise
+                print('WARNING: bulk insert error:', e, 'retrying')
+            else:
+                if status in (200, 201):
+                    return
+                if status not in RETRY_STATUS or attempt == self.retries:
+                    raise tapis_client.HTTPResponseError(status, 'bulk insert failed with status ' + str(status) + ': ' + data[:200].decode('utf-8', errors='replace'))
+                print('WARNING: bulk insert returned status', status, 'retrying')
+                if (response_headers.get('Retry-After') or '').isdigit():
+                    delay = max(delay, int(response_headers['Retry-After']))
+            time.sleep(delay)
+
+    def flush(self):
+        pass
+
+    def state(self):
+        return {}
+
+    def close(self):
+        self.pool.close()
+
+def loadCheckpoint(filename, dump_file):
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'r') as fp:
+        checkpoint = json.load(fp)
+    stat = os.stat(dump_file)
+    if checkpoint['dump'] != os.path.abspath(dump_file) or checkpoint['size'] != stat.st_size or checkpoint['mtime'] != stat.st_mtime:
+        raise ValueError('checkpoint ' + filename + ' is for a different or changed dump, use --restart to start over')
+    return checkpoint
+
+def saveCheckpoint(filename, checkpoint):
+    # write then rename, so an interrupted write keeps the last checkpoint
+    partial = filename + '.partial'
+    with open(partial, 'w') as fp:
+        json.dump(checkpoint, fp)
+    os.replace(partial, filename)
+
+class Progress:
+    def __init__(self, total_bytes, start_offset):
+        self.total_bytes = total_bytes
+        self.start_offset = start_offset
+        self.start = time.monotonic()
+        self.last_report = self.start
+        self.records = 0
+
+    def rate(self, offset):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        return (offset - self.start_offset) / elapsed / 1e6, self.records / elapsed, elapsed
+
+    def update(self, offset, records):
+        self.records += records
+        now = time.monotonic()
+        if now - self.last_report >= REPORT_INTERVAL:
+            self.last_report = now
+            mb_rate, record_rate, elapsed = self.rate(offset)
+            print('INFO: %.1f%% of dump, %.1f MB/s, %.0f records/s' % (100.0 * offset / max(1, self.total_bytes), mb_rate, record_rate))
+
+# Split the records of a chunk into batches of one V3 name, so each batch
+# is a single bulk insert. The batches only depend on the chunk, so they are
+# the same when a chunk is read again on resume.
+def chunkBatches(records, batch_size):
+    by_target = collections.OrderedDict()
+    for record in records:
+        by_target.setdefault(record[0], []).append(record)
+    batches = []
+    for target_records in by_target.values():
+        for i in range(0, len(target_records), batch_size):
+            batches.append(target_records[i:i + batch_size])
+    return batches
+
+# Chunks of the dump from the offset. A chunk which was partly written is
+# read again with the same byte range, so it splits into the same batches.
+def readChunks(filename, offset, chunk_end, chunk_size):
+    if chunk_end is not None:
+        with open(filename, 'rb') as fp:
+            fp.seek(offset)
+            data = fp.read(chunk_end - offset)
+        yield offset, chunk_end, data
+        offset = chunk_end
+    yield from meta_dump.readChunks(filename, offset, chunk_size)
+
+def migrate(args, sink, rules):
+    checkpoint = None
+    if args.restart:
+        if os.path.exists(args.checkpoint):
+            os.remove(args.checkpoint)
+    else:
+        checkpoint = loadCheckpoint(args.checkpoint, args.json_file)
+    offset = 0
+    chunk_end = None
+    skip_batches = 0
+    counts = collections.Counter()
+    if checkpoint:
+        offset = checkpoint['offset']
+        chunk_end = checkpoint.get('chunk_end')
+        skip_batches = checkpoint.get('batches', 0)
+        counts.update(checkpoint['counts'])
+        print('INFO: Resuming from byte offset', offset, 'after', skip_batches, 'batches')
+    sink.open(checkpoint['sink'] if checkpoint else None)
+
+    stat = os.stat(args.json_file)
+    size = stat.st_size
+    progress = Progress(size, offset)
+    pending = collections.deque()
+
+    def checkpointAt(offset, chunk_end, batches):
+        saveCheckpoint(args.checkpoint, {
+            'dump': os.path.abspath(args.json_file),
+            'size': size,
+            'mtime': stat.st_mtime,
+            'offset': offset,
+            'chunk_end': chunk_end,
+            'batches': batches,
+            'sink': sink.state(),
+            'counts': counts
+        })
+
+    def finishChunk(skip):
+        # results are taken in file order so the checkpoint offset covers
+        # every record before it
+        start, end, future = pending.popleft()
+        records, chunk_counts = future.result()
+        batches = chunkBatches(records, args.batch_size)
+        for i in range(skip, len(batches)):
+            sink.write(batches[i])
+            sink.flush()
+            if i + 1 < len(batches):
+                # the counts are only added once the whole chunk is written
+                checkpointAt(start, end, i + 1)
+        counts.update(chunk_counts)
+        checkpointAt(end, None, 0)
+        progress.update(end, len(records))
+        return end
+
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=initWorker, initargs=(rules,)) as executor:
+        for start, end, data in readChunks(args.json_file, offset, chunk_end, args.chunk_size):
+            # backpressure, wait for the oldest chunk when too many are in flight
+            while len(pending) >= args.max_pending:
+                offset = finishChunk(skip_batches)
+                skip_batches = 0
+            pending.append((start, end, executor.submit(transformChunk, data)))
+        while len(pending) > 0:
+            offset = finishChunk(skip_batches)
+            skip_batches = 0
+    sink.close()
+    return counts, progress.rate(offset)
+
+def printReport(counts, rates):
+    print(json.dumps(dict(sorted(counts.items())), indent=2))
+    migrated = sum(n for key, n in counts.items() if key.startswith('migrated '))
+    dropped = sum(n for key, n in counts.items() if key.startswith('dropped '))
+    unmapped = sum(n for key, n in counts.items() if key.startswith('unmapped '))
+    errors = sum(n for key, n in counts.items() if key.startswith('error '))
+    print('INFO:', migrated, 'records migrated,', dropped, 'dropped,', unmapped, 'unmapped,', errors, 'errors.')
+    mb_rate, record_rate, elapsed = rates
+    print('INFO: %.1f MB/s, %.0f records/s over %.1f seconds.' % (mb_rate, record_rate, elapsed))
+
+if (__name__=="__main__"):
+    parser = argparse.ArgumentParser(description='Migrate records in V2 Meta JSON file to V3.')
+    parser.add_argument('json_file', type=str, help='Input JSON file name')
+    parser.add_argument('target', type=str, help='Output file, SQLite database or API database URL, depending on --sink')
+    parser.add_argument('--sink', type=str, choices=['file', 'sqlite', 'api'], default='file', help='Where the V3 records are written')
+    parser.add_argument('-r', '--rules', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migration_rules.yaml'), help='Migration rules file')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Number of transform processes')
+    parser.add_argument('--chunk-size', type=int, default=4 * 1024 * 1024, help='Bytes of the dump in each chunk')
+    parser.add_argument('--max-pending', type=int, help='Maximum chunks in flight, default twice the jobs')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Records in each bulk insert')
+    parser.add_argument('--checkpoint', type=str, default='migrate.checkpoint', help='Checkpoint file for resuming')
+    parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint and start from the beginning')
+    args = parser.parse_args()
+    args.jobs = max(1, args.jobs)
+    if args.max_pending is None:
+        args.max_pending = args.jobs * 2
+    args.max_pending = max(1, args.max_pending)
+
+    rules = loadRules(args.rules)
+    if args.sink == 'file':
+        sink = FileSink(args.target)
+    elif args.sink == 'sqlite':
+        sink = SQLiteSink(args.target)
+    else:
+        token = os.getenv('TAPIS_V3_TOKEN')
+        if not token:
+            print('ERROR: Set TAPIS_V3_TOKEN for the API sink.')
+            sys.exit(1)
+        sink = APISink(args.target, token)
+
+    try:
+        counts, rates = migrate(args, sink, rules)
+    except ValueError as e:
+        print('ERROR:', e)
+        sys.exit(1)
+    except (OSError, http.client.HTTPException, tapis_client.HTTPResponseError) as e:
+        print('ERROR:', e)
+        print('ERROR: Run the same command again to resume from the last checkpoint.')
+        sys.exit(1)
+    printReport(counts, rates)
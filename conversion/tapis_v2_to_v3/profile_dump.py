@@ -0,0 +1,115 @@
+from __future__ import print_function
+import json
+import argparse
+import os
+import sys
+import time
+import collections
+import meta_dump
+
+# Profile a Meta JSON dump in a single pass. This answers the questions of
+# count_names.py and list_fields.py together: the count of each name, the
+# count of each value field for every name, and the number of errors.
+#
+# The file is split into line-aligned byte ranges which are parsed on a
+# pool of processes, and the partial profiles are merged at the end.
+
+# Offsets of the first few errors are kept so they can be inspected
+MAX_ERROR_OFFSETS = 10
+
+def emptyProfile():
+    return {
+        'names': collections.Counter(),
+        'fields': {},
+        'errors': collections.Counter(),
+        'error_offsets': [],
+        'lines': 0,
+        'records': 0,
+        'bytes': 0
+    }
+
+def profileRange(filename, start, end):
+    profile = emptyProfile()
+    names = profile['names']
+    fields = profile['fields']
+    errors = profile['errors']
+
+    def addError(kind, offset):
+        errors[kind] += 1
+        if len(profile['error_offsets']) < MAX_ERROR_OFFSETS:
+            profile['error_offsets'].append([kind, offset])
+
+    last_offset = None
+    for offset, item in meta_dump.readRecords(filename, start, end, lambda offset, e: addError('json', offset)):
+        if offset != last_offset:
+            profile['lines'] += 1
+            last_offset = offset
+        profile['records'] += 1
+        if not isinstance(item, dict) or 'name' not in item:
+            addError('no_name', offset)
+            continue
+        name = item['name']
+        names[name] += 1
+        value = item.get('value')
+        if not isinstance(value, dict):
+            addError('no_value', offset)
+            continue
+        counts = fields.get(name)
+        if counts is None:
+            counts = fields[name] = collections.Counter()
+        counts.update(value.keys())
+    profile['lines'] += errors['json']
+    profile['bytes'] = end - start
+    return profile
+
+def mergeProfiles(profiles):
+    total = emptyProfile()
+    for profile in profiles:
+        total['names'].update(profile['names'])
+        for name, counts in profile['fields'].items():
+            total['fields'].setdefault(name, collections.Counter()).update(counts)
+        total['errors'].update(profile['errors'])
+        total['error_offsets'].extend(profile['error_offsets'])
+        for key in ['lines', 'records', 'bytes']:
+            total[key] += profile[key]
+    total['error_offsets'] = sorted(total['error_offsets'], key=lambda e: e[1])[:MAX_ERROR_OFFSETS]
+    return total
+
+def profileDump(filename, jobs):
+    return mergeProfiles(meta_dump.scanRanges(filename, jobs, profileRange))
+
+def profileJSON(profile):
+    # sorted by count like the name counts in the README
+    return {
+        'names': dict(profile['names'].most_common()),
+        'fields': { name: dict(profile['fields'][name].most_common()) for name in sorted(profile['fields']) },
+        'errors': dict(profile['errors']),
+        'error_offsets': profile['error_offsets'],
+        'lines': profile['lines'],
+        'records': profile['records']
+    }
+
+if (__name__=="__main__"):
+    parser = argparse.ArgumentParser(description='Profile names, fields and errors in Meta JSON file.')
+    parser.add_argument('json_file', type=str, help='Input JSON file name')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Number of worker processes')
+    parser.add_argument('-n', '--name', type=str, action='append', help='Only list fields for this object name, may be repeated')
+    parser.add_argument('-o', '--output', type=str, help='Write the profile to this JSON file instead of printing it')
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    profile = profileDump(args.json_file, max(1, args.jobs))
+    elapsed = time.monotonic() - start
+
+    result = profileJSON(profile)
+    if args.name:
+        result['fields'] = { name: result['fields'].get(name, {}) for name in args.name }
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(result, fp, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
+
+    print(len(result['names']), 'names,', profile['records'], 'records,', profile['lines'], 'lines,', sum(profile['errors'].values()), 'errors', file=sys.stderr)
+    if elapsed > 0:
+        print('%.1f MB/s over %.1f seconds with %d jobs' % (profile['bytes'] / elapsed / 1e6, elapsed, args.jobs), file=sys.stderr)
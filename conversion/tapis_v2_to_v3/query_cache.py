@@ -0,0 +1,147 @@
+from __future__ import print_function
+import json
+import argparse
+import itertools
+import os
+import sys
+import cache_dump
+
+# Answer questions about a Meta JSON dump from the cache built by
+# cache_dump.py instead of parsing the dump.
+#
+#   names            count of records for each name, like count_names.py
+#   fields NAME      count of each value field of a name, like list_fields.py
+#   values NAME FIELD  count of each value of a cached field
+#   check RULES      dry run of fix_species.py with a rules file
+
+def stringId(db, value):
+    row = db.execute('SELECT id FROM strings WHERE value = ?', (value,)).fetchone()
+    return row[0] if row else None
+
+def countNames(db):
+    names = {}
+    for name, count in db.execute('SELECT s.value, COUNT(*) FROM records r JOIN strings s ON s.id = r.name GROUP BY r.name ORDER BY COUNT(*) DESC'):
+        names[name] = count
+    return names
+
+def listFields(db, object_name):
+    fields = {}
+    name_id = stringId(db, object_name)
+    for field, count in db.execute('SELECT field, count FROM name_fields WHERE name = ? ORDER BY count DESC', (name_id,)):
+        fields[field] = count
+    return fields
+
+def fieldId(db, path):
+    row = db.execute('SELECT id FROM fields WHERE path = ?', (path,)).fetchone()
+    return row[0] if row else None
+
+def countValues(db, object_name, path):
+    field_id = fieldId(db, path)
+    if field_id is None:
+        return None
+    values = {}
+    query = '''SELECT s.value, COUNT(*) FROM field_values fv JOIN records r ON r.id = fv.record JOIN strings s ON s.id = fv.value
+               WHERE fv.field = ? AND r.name = ? GROUP BY fv.value ORDER BY COUNT(*) DESC'''
+    for value, count in db.execute(query, (field_id, stringId(db, object_name))):
+        # values are keyed by their JSON text, so the string "1" and the
+        # number 1 are counted apart
+        values[value] = count
+    return values
+
+# Rebuild the part of each record which the rules check, for the records of
+# a name with a bad id in one of the cached rule fields
+def ruleRecords(db, name, paths):
+    fields = {}
+    for path in paths:
+        field_id = fieldId(db, '.'.join(path) + '.id')
+        if field_id is None:
+            raise ValueError('field ' + '.'.join(path) + '.id is not cached, rebuild the cache with --rules')
+        fields[field_id] = path
+    bad_values = []
+    for path, rewrite in paths.items():
+        for bad_id in rewrite:
+            value_id = stringId(db, json.dumps(bad_id))
+            if value_id is not None:
+                bad_values.append(value_id)
+    if not bad_values:
+        return
+    field_list = ','.join(str(f) for f in fields)
+    query = '''SELECT r.id, r.uuid, r.associations, fv.field, s.value FROM records r
+               JOIN field_values fv ON fv.record = r.id AND fv.field IN (''' + field_list + ''')
+               JOIN strings s ON s.id = fv.value
+               WHERE r.name = ? AND r.id IN (SELECT record FROM field_values WHERE field IN (''' + field_list + ''') AND value IN (''' + ','.join('?' * len(bad_values)) + '''))
+               ORDER BY r.id'''
+    rows = db.execute(query, [stringId(db, name)] + bad_values)
+    for record_id, group in itertools.groupby(rows, lambda row: row[0]):
+        value = {}
+        obj = None
+        for record_id, uuid, associations, field_id, v in group:
+            if obj is None:
+                obj = { 'uuid': uuid, 'name': name, 'associationIds': json.loads(associations), 'value': value }
+            # the ontology objects at the path, as found by findOntologies
+            path = fields[field_id]
+            node = value
+            for key in path[:-1]:
+                node = node.setdefault(key, {})
+            node.setdefault(path[-1], []).append({ 'id': json.loads(v) })
+        yield obj
+
+def checkRules(db, rules_file):
+    # fix_species.py is in the parent directory
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    import fix_species
+    rules = fix_species.loadRules(rules_file)
+    projects = []
+    cnt = 0
+    for name in sorted(rules.keys()):
+        for obj in ruleRecords(db, name, rules[name]):
+            result = fix_species.checkConversion(obj, rules)
+            if result['check']:
+                cnt += 1
+                for p in obj['associationIds']:
+                    if p not in projects:
+                        projects.append(p)
+    print('INFO:', cnt, 'total records converted.')
+    print('INFO:', len(projects), 'projects affected.')
+    print(projects)
+
+if (__name__=="__main__"):
+    parser = argparse.ArgumentParser(description='Query the column cache of Meta JSON file.')
+    parser.add_argument('json_file', type=str, help='Input JSON file name')
+    parser.add_argument('-c', '--cache', type=str, help='Cache file name, default is the JSON file name with .cache added')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('names', help='Count records for each name')
+    fields_parser = subparsers.add_parser('fields', help='Count value fields for a name')
+    fields_parser.add_argument('object_name', type=str, help='Object name')
+    values_parser = subparsers.add_parser('values', help='Count values of a cached field for a name')
+    values_parser.add_argument('object_name', type=str, help='Object name')
+    values_parser.add_argument('field', type=str, help='Cached dotted field path')
+    check_parser = subparsers.add_parser('check', help='Describe the conversions fix_species.py would make')
+    check_parser.add_argument('rules', type=str, help='fix_species.py rules file')
+    args = parser.parse_args()
+
+    db = cache_dump.openCache(args.json_file, args.cache)
+    if db is None:
+        sys.exit(1)
+
+    if args.command == 'names':
+        names = countNames(db)
+        print(json.dumps(names, indent=2))
+        print(len(names.keys()))
+    elif args.command == 'fields':
+        fields = listFields(db, args.object_name)
+        print(json.dumps(fields, indent=2))
+        print(len(fields.keys()))
+    elif args.command == 'values':
+        values = countValues(db, args.object_name, args.field)
+        if values is None:
+            print('ERROR: Field', args.field, 'is not cached, rebuild the cache with --field', args.field)
+            sys.exit(1)
+        print(json.dumps(values, indent=2))
+        print(len(values.keys()))
+    elif args.command == 'check':
+        try:
+            checkRules(db, args.rules)
+        except ValueError as e:
+            print('ERROR:', e)
+            sys.exit(1)
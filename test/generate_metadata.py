@@ -0,0 +1,331 @@
+import argparse
+import json
+import os
+import random
+import sys
+
+# Generate synthetic AIRR study metadata for scale testing of the metadata
+# import and export paths.
+#
+# The output is internally consistent: every repertoire references a
+# subject, has its own sample processing and a primary data processing,
+# and the subject and sample_processing tables use the same subject_id and
+# repertoire_id values as the AIRR repertoire file for the same seed.
+# Records are derived from the seed and their index and written one at a
+# time, so large corpora are reproducible and never held in memory.
+#
+# Formats:
+#   airr               AIRR repertoire JSON for /project/{uuid}/metadata/import
+#   subject            TSV for /project/{uuid}/metadata/import/table/subject
+#   sample_processing  TSV for /project/{uuid}/metadata/import/table/sample_processing
+
+FORMATS = ['airr', 'subject', 'sample_processing']
+
+SPECIES = [
+    { 'id': 'NCBITAXON:9606', 'label': 'Homo sapiens' },
+    { 'id': 'NCBITAXON:10090', 'label': 'Mus musculus' },
+    { 'id': 'NCBITAXON:9544', 'label': 'Macaca mulatta' }
+]
+SEX = ['male', 'female']
+AGE_UNIT = { 'id': 'UO:0000036', 'label': 'year' }
+DISEASES = [
+    { 'id': 'DOID:9744', 'label': 'type 1 diabetes mellitus' },
+    { 'id': 'DOID:0080600', 'label': 'COVID-19' },
+    { 'id': 'DOID:1612', 'label': 'breast cancer' },
+    { 'id': None, 'label': None }
+]
+STUDY_GROUPS = ['case', 'control']
+TISSUES = [
+    { 'id': 'UBERON:0000178', 'label': 'blood' },
+    { 'id': 'UBERON:0002106', 'label': 'spleen' },
+    { 'id': 'UBERON:0002371', 'label': 'bone marrow' }
+]
+CELL_SUBSETS = [
+    { 'id': 'CL:0000236', 'label': 'B cell' },
+    { 'id': 'CL:0000084', 'label': 'T cell' },
+    { 'id': 'CL:0000980', 'label': 'plasmablast' }
+]
+TEMPLATE_CLASS = ['DNA', 'RNA']
+LIBRARY_METHOD = ['PCR', 'RT(oligo-dT)+PCR', 'RT(specific)+PCR']
+PLATFORMS = ['Illumina MiSeq', 'Illumina NovaSeq 6000', 'Illumina HiSeq 2500']
+
+SUBJECT_COLUMNS = [
+    'subject_id', 'synthetic', 'species', 'sex', 'age_min', 'age_max', 'age_unit',
+    'age_event', 'ancestry_population', 'ethnicity', 'race', 'strain_name',
+    'diagnosis.0.study_group_description', 'diagnosis.0.disease_diagnosis',
+    'diagnosis.0.disease_length', 'diagnosis.0.disease_stage',
+    'diagnosis.0.prior_therapies', 'diagnosis.0.immunogen',
+    'diagnosis.0.intervention', 'diagnosis.0.medical_history'
+]
+
+SAMPLE_COLUMNS = [
+    'repertoire_id', 'subject_id', 'sample_id', 'sample_type', 'tissue',
+    'anatomic_site', 'disease_state_sample', 'collection_time_point_relative',
+    'collection_time_point_reference', 'biomaterial_provider', 'tissue_processing',
+    'cell_subset', 'cell_phenotype', 'cell_species', 'single_cell', 'cell_number',
+    'cells_per_reaction', 'cell_storage', 'cell_quality', 'cell_isolation',
+    'cell_processing_protocol', 'template_class', 'template_quality', 'template_amount',
+    'library_generation_method', 'library_generation_protocol',
+    'library_generation_kit_version', 'complete_sequences', 'physical_linkage',
+    'pcr_target.0.pcr_target_locus', 'pcr_target.0.forward_pcr_primer_target_location',
+    'pcr_target.0.reverse_pcr_primer_target_location', 'sequencing_run_id',
+    'total_reads_passing_qc_filter', 'sequencing_platform', 'sequencing_facility',
+    'sequencing_run_date', 'sequencing_kit', 'sequencing_files.file_type',
+    'sequencing_files.filename', 'sequencing_files.read_direction',
+    'sequencing_files.read_length', 'sequencing_files.paired_filename',
+    'sequencing_files.paired_read_direction', 'sequencing_files.paired_read_length'
+]
+
+class MetadataGenerator:
+    def __init__(self, repertoires, seed=0, repertoires_per_subject=4):
+        self.repertoires = repertoires
+        self.seed = seed
+        self.repertoires_per_subject = max(1, repertoires_per_subject)
+        self.subjects = (repertoires + self.repertoires_per_subject - 1) // self.repertoires_per_subject
+
+    def _random(self, kind, index):
+        # independent stream for each record so any record can be
+        # regenerated without generating those before it
+        return random.Random('%d-%s-%d' % (self.seed, kind, index))
+
+    def subjectId(self, index):
+        return 'subject-%07d' % index
+
+    def repertoireId(self, index):
+        return 'repertoire-%07d' % index
+
+    def subject(self, index):
+        rng = self._random('subject', index)
+        age = rng.randint(1, 90)
+        disease = rng.choice(DISEASES)
+        return {
+            'subject_id': self.subjectId(index),
+            'synthetic': True,
+            'species': dict(rng.choice(SPECIES)),
+            'sex': rng.choice(SEX),
+            'age_min': age,
+            'age_max': age,
+            'age_unit': dict(AGE_UNIT),
+            'age_event': 'enrollment',
+            'ancestry_population': None,
+            'ethnicity': None,
+            'race': None,
+            'strain_name': None,
+            'linked_subjects': None,
+            'link_type': None,
+            'diagnosis': [{
+                'study_group_description': rng.choice(STUDY_GROUPS) if disease['id'] else 'control',
+                'disease_diagnosis': dict(disease),
+                'disease_length': None,
+                'disease_stage': None,
+                'prior_therapies': None,
+                'immunogen': None,
+                'intervention': None,
+                'medical_history': None
+            }]
+        }
+
+    def sample(self, index, sample_index=0):
+        rng = self._random('sample', index * 1000 + sample_index)
+        cell_subset = rng.choice(CELL_SUBSETS)
+        locus = 'TRB' if cell_subset['id'] == 'CL:0000084' else rng.choice(['IGH', 'IGK', 'IGL'])
+        read_length = rng.choice([150, 250, 300])
+        sample_id = 'sample-%07d-%d' % (index, sample_index)
+        return {
+            'sample_processing_id': None,
+            'sample_id': sample_id,
+            'sample_type': 'peripheral venous puncture',
+            'tissue': dict(rng.choice(TISSUES)),
+            'anatomic_site': None,
+            'disease_state_sample': None,
+            'collection_time_point_relative': rng.randint(0, 365),
+            'collection_time_point_reference': 'enrollment',
+            'biomaterial_provider': None,
+            'tissue_processing': None,
+            'cell_subset': dict(cell_subset),
+            'cell_phenotype': None,
+            'cell_species': dict(SPECIES[0]),
+            'single_cell': False,
+            'cell_number': rng.randint(10000, 1000000),
+            'cells_per_reaction': None,
+            'cell_storage': False,
+            'cell_quality': None,
+            'cell_isolation': None,
+            'cell_processing_protocol': None,
+            'template_class': rng.choice(TEMPLATE_CLASS),
+            'template_quality': None,
+            'template_amount': None,
+            'library_generation_method': rng.choice(LIBRARY_METHOD),
+            'library_generation_protocol': None,
+            'library_generation_kit_version': None,
+            'pcr_target': [{
+                'pcr_target_locus': locus,
+                'forward_pcr_primer_target_location': None,
+                'reverse_pcr_primer_target_location': None
+            }],
+            'complete_sequences': 'partial',
+            'physical_linkage': 'none',
+            'sequencing_run_id': 'run-%05d' % (index // 96),
+            'total_reads_passing_qc_filter': rng.randint(10000, 5000000),
+            'sequencing_platform': rng.choice(PLATFORMS),
+            'sequencing_facility': None,
+            'sequencing_run_date': None,
+            'sequencing_kit': None,
+            'sequencing_files': {
+                'file_type': 'fastq',
+                'filename': sample_id + '_R1.fastq',
+                'read_direction': 'forward',
+                'read_length': read_length,
+                'paired_filename': sample_id + '_R2.fastq',
+                'paired_read_direction': 'reverse',
+                'paired_read_length': read_length
+            }
+        }
+
+    def repertoire(self, index):
+        return {
+            'repertoire_id': self.repertoireId(index),
+            'repertoire_name': None,
+            'repertoire_description': None,
+            'study': {
+                'study_id': 'synthetic-%d' % self.seed,
+                'study_title': 'Synthetic study'
+            },
+            'subject': self.subject(index // self.repertoires_per_subject),
+            'sample': [ self.sample(index) ],
+            'data_processing': [{
+                'data_processing_id': None,
+                'primary_annotation': True,
+                'software_versions': None,
+                'paired_reads_assembly': None,
+                'quality_thresholds': None,
+                'primer_match_cutoffs': None,
+                'collapsing_method': None,
+                'data_processing_protocols': None,
+                'data_processing_files': [ 'repertoire-%07d.airr.tsv.gz' % index ],
+                'germline_database': None,
+                'analysis_provenance_id': None
+            }]
+        }
+
+    def writeAIRR(self, fp):
+        # streamed AIRR DataFile, one repertoire at a time
+        fp.write('{"Repertoire": [\n')
+        for i in range(self.repertoires):
+            if i > 0:
+                fp.write(',\n')
+            fp.write(json.dumps(self.repertoire(i)))
+        fp.write('\n]}\n')
+
+    def writeSubjectTable(self, fp):
+        fp.write('\t'.join(SUBJECT_COLUMNS) + '\n')
+        for i in range(self.subjects):
+            fp.write('\t'.join(tableValue(flatten(self.subject(i)).get(column)) for column in SUBJECT_COLUMNS) + '\n')
+
+    def writeSampleTable(self, fp):
+        # one sample processing row per repertoire
+        fp.write('\t'.join(SAMPLE_COLUMNS) + '\n')
+        for i in range(self.repertoires):
+            row = flatten(self.sample(i))
+            row['repertoire_id'] = self.repertoireId(i)
+            row['subject_id'] = self.subjectId(i // self.repertoires_per_subject)
+            fp.write('\t'.join(tableValue(row.get(column)) for column in SAMPLE_COLUMNS) + '\n')
+
+    def write(self, output_format, fp):
+        if output_format == 'airr':
+            self.writeAIRR(fp)
+        elif output_format == 'subject':
+            self.writeSubjectTable(fp)
+        elif output_format == 'sample_processing':
+            self.writeSampleTable(fp)
+        else:
+            raise ValueError('unknown format: ' + str(output_format))
+
+def flatten(obj):
+    # Flatten to table columns the way metadata tables are exported:
+    # ontology objects become their id, arrays become name.N.field and
+    # other objects become name.field.
+    row = {}
+    for key, value in obj.items():
+        if isinstance(value, list):
+            for i, item in enumerate(value):
+                for field, field_value in flatten(item).items():
+                    row[key + '.' + str(i) + '.' + field] = field_value
+        elif isinstance(value, dict):
+            if 'id' in value and 'label' in value:
+                row[key] = value['id']
+            else:
+                for field, field_value in flatten(value).items():
+                    row[key + '.' + field] = field_value
+        else:
+            row[key] = value
+    return row
+
+def tableValue(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+def outputFilename(output_format, repertoires, seed=0, repertoires_per_subject=4):
+    # name which identifies the generated content
+    extension = '.json' if output_format == 'airr' else '.tsv'
+    return 'synthetic_%s_%d_%d_%d%s' % (output_format, repertoires, repertoires_per_subject, seed, extension)
+
+def generateFile(filename, output_format, repertoires, seed=0, repertoires_per_subject=4):
+    # Write to a temporary name first so a partial file is never used
+    generator = MetadataGenerator(repertoires, seed, repertoires_per_subject)
+    partial = filename + '.partial'
+    with open(partial, 'w') as fp:
+        generator.write(output_format, fp)
+    os.replace(partial, filename)
+    return filename
+
+def getArguments():
+    # Set up the command line parser
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="Generate synthetic AIRR metadata for scale testing the metadata import and export endpoints."
+    )
+
+    parser.add_argument(
+        "-n",
+        "--repertoires",
+        type=int,
+        default=10,
+        help="Number of repertoires.")
+    parser.add_argument(
+        "-f",
+        "--format",
+        type=str,
+        choices=FORMATS,
+        default="airr",
+        help="Output format.")
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Random seed, the same seed always generates the same metadata.")
+    parser.add_argument(
+        "--repertoires-per-subject",
+        type=int,
+        default=4,
+        help="Number of repertoires for each subject.")
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        help="Output file. Default is standard output.")
+
+    # Parse the command line arguements.
+    options = parser.parse_args()
+    return options
+
+if __name__ == "__main__":
+    options = getArguments()
+    if options.output:
+        generateFile(options.output, options.format, options.repertoires, options.seed, options.repertoires_per_subject)
+    else:
+        generator = MetadataGenerator(options.repertoires, options.seed, options.repertoires_per_subject)
+        generator.write(options.format, sys.stdout)
@@ -0,0 +1,426 @@
+import re
+import threading
+
+# Response checks for test_driver.py, compiled once and reused for every
+# request, so checking stays cheap when entries are replayed thousands of
+# times by the benchmark and soak commands.
+#
+# Assertions pick values out of the JSON response with a path like
+# $.result[0].uuid or $[*].message and check them:
+#
+#   assert:
+#     - path: $.status
+#       equals: success
+#     - path: $.result[*].uuid
+#       exists: true
+#     - path: $.message
+#       matches: '^duplicate'
+#
+# Response schemas come from the OpenAPI definition of the API. Each schema
+# is compiled into a validator function the first time it is used, and the
+# validator is cached by schema.
+
+# Steps of a JSON path: .name, ['name'], [0] or [*]
+PATH_STEP = re.compile(r"\.([A-Za-z_$][\w$-]*)|\['([^']*)'\]|\[(-?[0-9]+)\]|\[\*\]|\.\*")
+
+# Errors reported for one schema validation
+MAX_SCHEMA_ERRORS = 5
+
+class AssertionSpecError(Exception):
+    pass
+
+def compilePath(path):
+    # Returns a function giving the list of values at the path
+    if not path.startswith('$'):
+        raise AssertionSpecError('JSON path must start with $: ' + path)
+    steps = []
+    position = 1
+    while position < len(path):
+        match = PATH_STEP.match(path, position)
+        if match is None:
+            raise AssertionSpecError('invalid JSON path ' + path + ' at ' + path[position:])
+        if match.group(1) is not None:
+            steps.append(('key', match.group(1)))
+        elif match.group(2) is not None:
+            steps.append(('key', match.group(2)))
+        elif match.group(3) is not None:
+            steps.append(('index', int(match.group(3))))
+        else:
+            steps.append(('all', None))
+        position = match.end()
+
+    def select(data):
+        values = [data]
+        for kind, arg in steps:
+            selected = []
+            for value in values:
+                if kind == 'key':
+                    if isinstance(value, dict) and arg in value:
+                        selected.append(value[arg])
+                elif kind == 'index':
+                    if isinstance(value, list) and -len(value) <= arg < len(value):
+                        selected.append(value[arg])
+                elif isinstance(value, list):
+                    selected.extend(value)
+                elif isinstance(value, dict):
+                    selected.extend(value.values())
+            values = selected
+        return values
+    return select
+
+def contains(value, expected):
+    try:
+        return expected in value
+    except TypeError:
+        return False
+
+TYPE_NAMES = {
+    'dict': dict, 'object': dict,
+    'list': list, 'array': list,
+    'str': str, 'string': str,
+    'int': int, 'integer': int,
+    'float': float, 'number': (int, float),
+    'bool': bool, 'boolean': bool,
+    'null': type(None)
+}
+
+def compileCheck(op, expected):
+    # Returns a function testing one value
+    if op == 'equals':
+        return lambda value: value == expected
+    if op == 'contains':
+        return lambda value: contains(value, expected)
+    if op == 'matches':
+        pattern = re.compile(expected)
+        return lambda value: isinstance(value, str) and pattern.search(value) is not None
+    if op == 'type':
+        if expected not in TYPE_NAMES:
+            raise AssertionSpecError('unknown type ' + str(expected))
+        python_type = TYPE_NAMES[expected]
+        if python_type in (int, (int, float)):
+            return lambda value: isinstance(value, python_type) and not isinstance(value, bool)
+        return lambda value: isinstance(value, python_type)
+    if op == 'length':
+        return lambda value: hasattr(value, '__len__') and len(value) == expected
+    if op == 'min_length':
+        return lambda value: hasattr(value, '__len__') and len(value) >= expected
+    raise AssertionSpecError('unknown assertion ' + op)
+
+ASSERTION_OPS = ['equals', 'contains', 'matches', 'type', 'length', 'min_length']
+
+def compileAssertion(spec):
+    # An assertion passes when any value at the path passes its check, or
+    # with all: true when every value passes. exists checks that the path
+    # has a value, or with false that it has none.
+    if not isinstance(spec, dict) or 'path' not in spec:
+        raise AssertionSpecError('assertion needs a path: ' + str(spec))
+    select = compilePath(spec['path'])
+    ops = [op for op in spec if op in ASSERTION_OPS]
+    unknown = [key for key in spec if key not in ASSERTION_OPS + ['path', 'exists', 'all', 'message']]
+    if unknown:
+        raise AssertionSpecError('unknown assertion ' + ', '.join(unknown))
+    checks = [compileCheck(op, spec[op]) for op in ops]
+    exists = spec.get('exists', True)
+    every = spec.get('all', False)
+    message = spec.get('message') or ('failed assertion on ' + spec['path'] + (' ' + ops[0] if ops else ''))
+
+    def check(data):
+        values = select(data)
+        if not exists:
+            return message if values else None
+        if not values:
+            return message
+        for test in checks:
+            if every:
+                if not all(test(value) for value in values):
+                    return message
+            elif not any(test(value) for value in values):
+                return message
+        return None
+    return check
+
+def compileResponse(response, response_type):
+    # The response entries of parameter_tests.yaml: each value must be in
+    # the response field, or for a list response in the field of one of
+    # the list entries.
+    checks = []
+    for field, expected in response.items():
+        spec = { 'contains': expected, 'message': 'incorrect response for ' + field }
+        if response_type == 'list':
+            spec['path'] = "$[*]['" + field + "']"
+        else:
+            spec['path'] = "$['" + field + "']"
+        checks.append(compileAssertion(spec))
+    return checks
+
+class AssertionCache:
+    # Compiled checks for each entry, keyed by the entry's assert list and
+    # response dict, which are shared by the copies of an entry replayed by
+    # the benchmark. The objects are kept so their ids are not reused.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.compiled = {}
+
+    def checks(self, entry):
+        key = (id(entry.get('assert')), id(entry.get('response')))
+        with self.lock:
+            cached = self.compiled.get(key)
+            if cached is None:
+                checks = []
+                if entry.get('response'):
+                    checks.extend(compileResponse(entry['response'], entry.get('response_type')))
+                for spec in entry.get('assert') or []:
+                    checks.append(compileAssertion(spec))
+                cached = (entry.get('assert'), entry.get('response'), checks)
+                self.compiled[key] = cached
+        return cached[2]
+
+def jsonType(value):
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'boolean'
+    if isinstance(value, int):
+        return 'integer'
+    if isinstance(value, float):
+        return 'number'
+    if isinstance(value, str):
+        return 'string'
+    if isinstance(value, list):
+        return 'array'
+    if isinstance(value, dict):
+        return 'object'
+    return type(value).__name__
+
+class SchemaCompiler:
+    # Compiles OpenAPI 3.0 schemas into validator functions using only the
+    # standard library. A validator is called as validate(value, path,
+    # errors) and appends a message to errors for each problem found.
+    #
+    # Supported: type, nullable (also x-airr nullable), enum, required,
+    # properties, additionalProperties, items, allOf, anyOf, oneOf,
+    # minLength, maxLength, pattern, minimum, maximum, minItems, maxItems
+    # and $ref. References to component schemas, or to other schema files
+    # like the AIRR specification, are looked up by name in the schema
+    # definitions. Other references are JSON pointers into the document. A
+    # reference which cannot be resolved fails validation.
+    def __init__(self, document, definitions):
+        self.document = document
+        self.definitions = definitions
+        self.lock = threading.RLock()
+        self.by_ref = {}
+        self.by_id = {}
+
+    def _resolve(self, ref):
+        fragment = ref.split('#', 1)[1] if '#' in ref else ''
+        parts = [part for part in fragment.split('/') if part]
+        if parts and (not ref.startswith('#') or parts[:2] == ['components', 'schemas'] or len(parts) == 1):
+            name = parts[-1]
+            if name in self.definitions:
+                return self.definitions[name]
+        node = self.document
+        for part in parts:
+            part = part.replace('~1', '/').replace('~0', '~')
+            if not isinstance(node, dict) or part not in node:
+                return None
+            node = node[part]
+        return node if ref.startswith('#') and parts else None
+
+    def compileRef(self, ref):
+        with self.lock:
+            validator = self.by_ref.get(ref)
+            if validator is not None:
+                return validator
+            # placeholder so recursive schemas refer to the validator being compiled
+            target = []
+            self.by_ref[ref] = lambda value, path, errors: target[0](value, path, errors)
+            schema = self._resolve(ref)
+            if schema is None:
+                # fail rather than pass, so a misspelled schema name or a
+                # missing schema file is not mistaken for a valid response
+                target.append(lambda value, path, errors: errors.append('unresolved schema ' + ref))
+            else:
+                target.append(self.compile(schema))
+            self.by_ref[ref] = target[0]
+            return target[0]
+
+    def compile(self, schema):
+        if not isinstance(schema, dict):
+            return lambda value, path, errors: None
+        with self.lock:
+            cached = self.by_id.get(id(schema))
+            if cached is not None and cached[0] is schema:
+                return cached[1]
+            validator = self._compile(schema)
+            self.by_id[id(schema)] = (schema, validator)
+            return validator
+
+    def _compile(self, schema):
+        if '$ref' in schema:
+            return self.compileRef(schema['$ref'])
+
+        checks = []
+        nullable = schema.get('nullable') or (isinstance(schema.get('x-airr'), dict) and schema['x-airr'].get('nullable'))
+        schema_type = schema.get('type')
+        if schema_type is not None:
+            allowed = set(schema_type if isinstance(schema_type, list) else [schema_type])
+            if 'number' in allowed:
+                allowed.add('integer')
+            if nullable:
+                allowed.add('null')
+
+            def checkType(value, path, errors):
+                if jsonType(value) not in allowed:
+                    errors.append(path + ' is ' + jsonType(value) + ', expected ' + '/'.join(sorted(allowed)))
+                    return False
+                return True
+            checks.append(checkType)
+
+        if 'enum' in schema:
+            enum = list(schema['enum'])
+            if nullable:
+                enum.append(None)
+            def checkEnum(value, path, errors):
+                if value not in enum:
+                    errors.append(path + ' is not one of ' + ', '.join(str(e) for e in enum))
+            checks.append(checkEnum)
+
+        if 'pattern' in schema:
+            pattern = re.compile(schema['pattern'])
+            def checkPattern(value, path, errors):
+                if isinstance(value, str) and pattern.search(value) is None:
+                    errors.append(path + ' does not match ' + schema['pattern'])
+            checks.append(checkPattern)
+
+        for key, test, text in [
+            ('minLength', lambda v, n: not isinstance(v, str) or len(v) >= n, 'shorter than'),
+            ('maxLength', lambda v, n: not isinstance(v, str) or len(v) <= n, 'longer than'),
+            ('minimum', lambda v, n: jsonType(v) not in ('integer', 'number') or v >= n, 'less than'),
+            ('maximum', lambda v, n: jsonType(v) not in ('integer', 'number') or v <= n, 'greater than'),
+            ('minItems', lambda v, n: not isinstance(v, list) or len(v) >= n, 'fewer items than'),
+            ('maxItems', lambda v, n: not isinstance(v, list) or len(v) <= n, 'more items than')]:
+            if key in schema:
+                def checkLimit(value, path, errors, test=test, limit=schema[key], text=text):
+                    if not test(value, limit):
+                        errors.append(path + ' is ' + text + ' ' + str(limit))
+                checks.append(checkLimit)
+
+        required = schema.get('required') or []
+        properties = { name: self.compile(prop) for name, prop in (schema.get('properties') or {}).items() }
+        additional = schema.get('additionalProperties', True)
+        additional_validator = self.compile(additional) if isinstance(additional, dict) else None
+        if required or properties or additional is not True:
+            def checkObject(value, path, errors):
+                if not isinstance(value, dict):
+                    return
+                for name in required:
+                    if name not in value:
+                        errors.append(path + '.' + name + ' is required')
+                for name, item in value.items():
+                    validator = properties.get(name)
+                    if validator is not None:
+                        validator(item, path + '.' + name, errors)
+                    elif additional is False:
+                        errors.append(path + '.' + name + ' is not allowed')
+                    elif additional_validator is not None:
+                        additional_validator(item, path + '.' + name, errors)
+            checks.append(checkObject)
+
+        if isinstance(schema.get('items'), dict):
+            item_validator = self.compile(schema['items'])
+            def checkItems(value, path, errors):
+                if not isinstance(value, list):
+                    return
+                for i, item in enumerate(value):
+                    item_validator(item, path + '[' + str(i) + ']', errors)
+                    if len(errors) >= MAX_SCHEMA_ERRORS:
+                        return
+            checks.append(checkItems)
+
+        if 'allOf' in schema:
+            validators = [self.compile(s) for s in schema['allOf']]
+            def checkAllOf(value, path, errors):
+                for validator in validators:
+                    validator(value, path, errors)
+            checks.append(checkAllOf)
+
+        for key in ['anyOf', 'oneOf']:
+            if key in schema:
+                validators = [self.compile(s) for s in schema[key]]
+                def checkOf(value, path, errors, validators=validators, key=key):
+                    passed = 0
+                    for validator in validators:
+                        sub_errors = []
+                        validator(value, path, sub_errors)
+                        if not sub_errors:
+                            passed += 1
+                    if passed == 0 or (key == 'oneOf' and passed > 1):
+                        errors.append(path + ' does not match ' + key + ' schemas')
+                checks.append(checkOf)
+
+        def validate(value, path, errors):
+            for check in checks:
+                # skip the remaining checks when the type is wrong
+                if check(value, path, errors) is False:
+                    return
+                if len(errors) >= MAX_SCHEMA_ERRORS:
+                    return
+        return validate
+
+class OpenAPISpec:
+    # Response schemas of an OpenAPI document, found by method, request path
+    # and status code. Request paths are matched against the path templates,
+    # with literal paths before templates with parameters.
+    def __init__(self, document, definitions):
+        self.document = document
+        self.compiler = SchemaCompiler(document, definitions)
+        self.lock = threading.Lock()
+        self.operations = {}
+        self.templates = []
+        for template in (document.get('paths') or {}):
+            regex = re.compile('^' + re.sub(r'\\\{[^/}]*\\\}', '[^/]+', re.escape(template)) + '/?$')
+            self.templates.append((template.count('{'), template, regex))
+        self.templates.sort(key=lambda t: (t[0], -len(t[1])))
+
+    def matchTemplate(self, path):
+        path = path.split('?', 1)[0]
+        for params, template, regex in self.templates:
+            if regex.match(path):
+                return template
+        return None
+
+    def validator(self, method, path, code):
+        # Returns the validator for the response, or None with a message
+        # when the document has no JSON schema for it
+        template = self.matchTemplate(path)
+        if template is None:
+            return None, 'no API path matches ' + path
+        key = (method.lower(), template, str(code))
+        with self.lock:
+            if key in self.operations:
+                return self.operations[key]
+        operation = self.document['paths'][template].get(method.lower())
+        if operation is None:
+            result = (None, 'no ' + method + ' operation for ' + template)
+        else:
+            responses = operation.get('responses') or {}
+            response = responses.get(str(code), responses.get(code, responses.get('default')))
+            content = (response or {}).get('content') or {}
+            schema = (content.get('application/json') or {}).get('schema')
+            if schema is None:
+                result = (None, 'no JSON response schema for ' + method + ' ' + template + ' ' + str(code))
+            else:
+                result = (self.compiler.compile(schema), None)
+        with self.lock:
+            self.operations[key] = result
+        return result
+
+    def schemaValidator(self, name):
+        # validator for a named schema, like BasicResponse
+        ref = name if name.startswith('#') else '#/components/schemas/' + name
+        return self.compiler.compileRef(ref)
+
+def validate(validator, value):
+    errors = []
+    validator(value, '$', errors)
+    return errors
@@ -0,0 +1,240 @@
+import argparse
+import hashlib
+import http.server
+import json
+import random
+import sys
+import threading
+import time
+
+# Local stand-in for the VDJServer API which replays the requests and
+# responses captured by "test_driver.py --record". This lets the test
+# driver, and its concurrency and benchmark modes, run without a network.
+#
+# Like errorInjection.js in the API, errors can be injected. An injected
+# error is named by the method and path of a request, for example
+# "POST /api/v2/user", and the stand-in responds with an error for that
+# request instead of the recorded response. Errors can be given on the
+# command line or set while running with a POST to /__stub__/error.
+
+STUB_PATH = '/__stub__/error'
+
+class FixtureStore:
+    def __init__(self, filename):
+        # Recorded responses are matched on method, path and request body
+        # hash, with a fallback to method and path only.
+        self.exact = {}
+        self.route = {}
+        self.count = 0
+        with open(filename, 'r') as fp:
+            for line in fp:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                self.exact.setdefault((record['method'], record['path'], record['request_sha256']), []).append(record)
+                self.route.setdefault((record['method'], record['path']), []).append(record)
+                self.count += 1
+        self.next = {}
+        self.lock = threading.Lock()
+
+    def lookup(self, method, path, body):
+        body_hash = hashlib.sha256(body).hexdigest() if body else None
+        records = self.exact.get((method, path, body_hash))
+        if records is None:
+            records = self.route.get((method, path))
+        if records is None:
+            return None
+        # cycle through responses recorded for the same request
+        key = id(records)
+        with self.lock:
+            index = self.next.get(key, 0)
+            self.next[key] = index + 1
+        return records[index % len(records)]
+
+class ErrorInjection:
+    def __init__(self, errors, error_code, error_rate, seed):
+        self.errors = {}
+        for error in errors:
+            self.setError(error)
+        self.error_code = error_code
+        self.error_rate = error_rate
+        self.current = None
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def setError(self, error):
+        # "METHOD PATH" or "METHOD PATH=CODE"
+        code = None
+        if '=' in error:
+            error, code = error.rsplit('=', 1)
+            code = int(code)
+        self.errors[error.strip()] = code
+
+    def setCurrentError(self, error):
+        self.current = error
+        print('STUB WARNING: Current error injection:', self.current)
+        return self.current
+
+    def shouldInjectError(self, route):
+        if route == self.current or route in self.errors:
+            return True
+        if self.error_rate > 0:
+            with self.lock:
+                return self.random.random() < self.error_rate
+        return False
+
+    def errorCode(self, route):
+        if self.errors.get(route) is not None:
+            return self.errors[route]
+        return self.error_code
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    # keep-alive, so connection pooling in the driver is exercised
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, avoid delayed ACK stalls
+    disable_nagle_algorithm = True
+
+    def sendResponse(self, code, body, content_type='application/json'):
+        data = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def readBody(self):
+        length = self.headers.get('Content-Length')
+        if length is not None:
+            return self.rfile.read(int(length))
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return b''.join(chunks)
+        return b''
+
+    def handleRequest(self):
+        body = self.readBody()
+        server = self.server
+        if self.path == STUB_PATH:
+            error = json.loads(body).get('error') if body else None
+            server.injection.setCurrentError(error)
+            self.sendResponse(200, json.dumps({ 'status': 'success', 'result': error }))
+            return
+
+        if server.latency > 0 or server.jitter > 0:
+            time.sleep(max(0.0, server.latency + random.uniform(-server.jitter, server.jitter)))
+
+        route = self.command + ' ' + self.path.split('?')[0]
+        if server.injection.shouldInjectError(route):
+            code = server.injection.errorCode(route)
+            self.sendResponse(code, json.dumps({ 'status': 'error', 'message': 'STUB INJECTED ERROR: ' + route }))
+            return
+
+        record = server.fixtures.lookup(self.command, self.path, body)
+        if record is None:
+            self.sendResponse(404, json.dumps({ 'status': 'error', 'message': 'no recorded response for ' + route }))
+            return
+        self.sendResponse(record['status'], record['body'], record.get('content_type') or 'application/json')
+
+    def do_GET(self):
+        self.handleRequest()
+
+    def do_POST(self):
+        self.handleRequest()
+
+    def do_PUT(self):
+        self.handleRequest()
+
+    def do_DELETE(self):
+        self.handleRequest()
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            http.server.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+def getArguments():
+    # Set up the command line parser
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="Replay recorded test driver requests from a local HTTP server."
+    )
+
+    # recorded fixtures
+    parser.add_argument("fixtures", help="Fixture file written by test_driver.py --record.")
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="Address to listen on.")
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8080,
+        help="Port to listen on.")
+    # injected latency
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="Seconds of latency added to every response.")
+    parser.add_argument(
+        "--jitter",
+        type=float,
+        default=0.0,
+        help="Random variation in seconds added to the latency.")
+    # injected errors
+    parser.add_argument(
+        "--inject",
+        type=str,
+        action="append",
+        default=[],
+        help="Always fail a request, given as 'METHOD PATH' or 'METHOD PATH=CODE'. May be repeated.")
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of requests which fail at random.")
+    parser.add_argument(
+        "--error-code",
+        type=int,
+        default=500,
+        help="HTTP status code for injected errors.")
+    parser.add_argument(
+        "--seed",
+        type=int,
+        help="Seed for random error injection.")
+    # Verbosity flag
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Log every request.")
+
+    # Parse the command line arguements.
+    options = parser.parse_args()
+    return options
+
+if __name__ == "__main__":
+    options = getArguments()
+
+    server = http.server.ThreadingHTTPServer((options.host, options.port), StubHandler)
+    server.daemon_threads = True
+    server.fixtures = FixtureStore(options.fixtures)
+    server.injection = ErrorInjection(options.inject, options.error_code, options.error_rate, options.seed)
+    server.latency = options.latency
+    server.jitter = options.jitter
+    server.verbose = options.verbose
+
+    print('INFO: Replaying', server.fixtures.count, 'recorded responses on http://%s:%d' % (options.host, options.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    sys.exit(0)
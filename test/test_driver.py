@@ -1,20 +1,180 @@
-import urllib.request, urllib.parse
+import urllib.parse
 import argparse
+import codecs
+import glob
+import hashlib
+import http.client
+import itertools
 import json
+import math
 import os, ssl
+import re
 import sys
+import threading
 import time
 import yaml
+import zlib
+import generate_metadata
+import response_assertions
+# the API client is shared with the conversion scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'conversion'))
+import tapis_client
+from tapis_client import ConnectionPool, HTTPResponseError, STREAM_CHUNK_SIZE
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
 
 PASS_STRING = 'PASS'
 FAIL_STRING = 'FAIL'
 SKIP_STRING = 'SKIP'
 
-def processQuery(query_url, header_dict, expect_code, query_dict, verbose=False, force=False, expect_format='json'):
+# Array entries in TSV exports, like diagnosis.0.disease_diagnosis
+INDEXED_COLUMN_PATTERN = re.compile(r'^[A-Za-z_]+\.[0-9]+\.')
+
+# Data files up to this size are checked to be valid JSON before sending
+JSON_CHECK_SIZE = 1048576
+
+# Tapis style UUIDs in endpoint paths
+UUID_PATTERN = re.compile(r'[0-9a-fA-F]{8,}-[0-9a-fA-F-]*[0-9a-fA-F]')
+
+class DataFileBody:
+    # Request body read from a data file in chunks as it is sent, so large
+    # files are never held in memory. The body is either sent with its file
+    # size as Content-Length, or with chunked transfer encoding when it is
+    # compressed or chunked is requested. Iterating again restarts from the
+    # beginning of the file, so a request can be retried. A hash of the bytes
+    # sent is kept for fixture recording.
+    def __init__(self, filename, content_type='application/json', compress=False, chunked=False):
+        self.filename = filename
+        self.content_type = content_type
+        self.compress = compress
+        self.chunked = chunked or compress
+        self.sent = 0
+        self.sha256 = None
+
+    def headers(self):
+        headers = { 'Content-Type': self.content_type }
+        if self.compress:
+            headers['Content-Encoding'] = 'gzip'
+        if not self.chunked:
+            headers['Content-Length'] = str(os.path.getsize(self.filename))
+        return headers
+
+    def __iter__(self):
+        self.sent = 0
+        self.sha256 = None
+        digest = hashlib.sha256()
+        compressor = zlib.compressobj(wbits=31) if self.compress else None
+        with open(self.filename, 'rb') as fp:
+            chunk = fp.read(STREAM_CHUNK_SIZE)
+            while chunk:
+                if compressor is not None:
+                    chunk = compressor.compress(chunk)
+                if chunk:
+                    self.sent += len(chunk)
+                    digest.update(chunk)
+                    yield chunk
+                chunk = fp.read(STREAM_CHUNK_SIZE)
+        if compressor is not None:
+            chunk = compressor.flush()
+            self.sent += len(chunk)
+            digest.update(chunk)
+            yield chunk
+        self.sha256 = digest.hexdigest()
+
+class TSVValidator:
+    # Incremental TSV parser for streamed responses. Only the header and
+    # counts are kept, so exports of any size are checked in constant memory.
+    def __init__(self, encoding='utf-8'):
+        self.decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        self.partial = ''
+        self.header = None
+        self.rows = 0
+        self.bad_rows = 0
+        self.first_bad_row = None
+
+    def feed(self, chunk):
+        lines = (self.partial + self.decoder.decode(chunk)).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self._processLine(line)
+
+    def close(self):
+        line = self.partial + self.decoder.decode(b'', final=True)
+        self.partial = ''
+        if line:
+            self._processLine(line)
+
+    def _processLine(self, line):
+        line = line.rstrip('\r')
+        if self.header is None:
+            self.header = line.split('\t')
+            return
+        if len(line) == 0:
+            return
+        self.rows += 1
+        if line.count('\t') + 1 != len(self.header):
+            self.bad_rows += 1
+            if self.first_bad_row is None:
+                self.first_bad_row = self.rows
+
+    def __str__(self):
+        return 'TSV ' + str(len(self.header or [])) + ' columns, ' + str(self.rows) + ' rows'
+
+class FixtureRecorder:
+    # Capture each request and its response as JSON Lines so they can be
+    # replayed by stub_server.py. Only a hash of the request body is kept,
+    # which is enough to match requests and keeps passwords out of the file.
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.fp = open(filename, 'w')
+        self.count = 0
+
+    def record(self, method, url, body, status, headers, data):
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path
+        if parts.query:
+            path += '?' + parts.query
+        record = {
+            'method': method,
+            'path': path,
+            'request_sha256': hashlib.sha256(body).hexdigest() if isinstance(body, bytes) else getattr(body, 'sha256', None),
+            'status': status,
+            'content_type': headers.get('Content-Type'),
+            'body': redactTokens(data.decode('utf-8', errors='replace'))
+        }
+        with self.lock:
+            self.fp.write(json.dumps(record) + '\n')
+            self.count += 1
+
+    def close(self):
+        self.fp.close()
+
+def redactTokens(text):
+    # do not write live tokens from /token responses to fixture files
+    try:
+        obj = json.loads(text)
+    except ValueError:
+        return text
+    if isinstance(obj, dict) and isinstance(obj.get('result'), dict):
+        for field in ['access_token', 'refresh_token']:
+            if obj['result'].get(field) is not None:
+                obj['result'][field] = 'recorded-' + field
+        return json.dumps(obj)
+    return text
+
+# shared by getAuthToken() and testAPI(), set up in initHTTP()
+connection_pool = ConnectionPool()
+
+def processQuery(query_url, header_dict, expect_code, query_dict, verbose=False, force=False, expect_format='json', timing=None, method=None):
     # Build the required JSON data for the post request. The user
     # of the function provides both the header and the query data
 
-    if query_dict:
+    if isinstance(query_dict, DataFileBody):
+        # Data files are streamed from disk
+        query_json_encoded = query_dict
+        header_dict = dict(header_dict)
+        header_dict.update(query_dict.headers())
+    elif query_dict:
         # Convert the query dictionary to JSON
         query_json = json.dumps(query_dict)
 
@@ -26,33 +186,28 @@ def processQuery(query_url, header_dict, expect_code, query_dict, verbose=False,
     # Try to connect the URL and get a response. On error return an
     # empty JSON array.
     try:
-        # Build the request
-        request = urllib.request.Request(query_url, query_json_encoded, header_dict)
-        # Make the request and get a handle for the response.
-        response = urllib.request.urlopen(request)
-        # Read the response
-        url_response = response.read()
+        # Make the request on a pooled connection and read the response.
+        if method is None:
+            method = 'POST' if query_json_encoded is not None else 'GET'
+        # TSV responses can be very large so they are validated as they
+        # stream in rather than buffered.
+        reader = TSVValidator() if expect_format == 'tsv' else None
+        code, response_headers, url_response = connection_pool.request(method, query_url, query_json_encoded, header_dict, timing, reader)
         # If we have a charset for the response, decode using it, otherwise assume utf-8
-        if not response.headers.get_content_charset() is None:
-            url_response = url_response.decode(response.headers.get_content_charset())
-        else:
-            url_response = url_response.decode("utf-8")
+        if reader is None:
+            if not response_headers.get_content_charset() is None:
+                url_response = url_response.decode(response_headers.get_content_charset())
+            else:
+                url_response = url_response.decode("utf-8")
         # Check if pass when should have failed
-        if response.code != expect_code:
+        if code != expect_code:
             if verbose:
-                print('ERROR: Wrong HTTP status code:', response.code, '!=', expect_code)
+                print('ERROR: Wrong HTTP status code:', code, '!=', expect_code)
             return None
 
-    except urllib.error.HTTPError as e:
-        if e.code != expect_code:
-            if verbose:
-                print('ERROR: Wrong HTTP status code:', e.code, '!=', expect_code)
-            return None
-        url_response = e.read()
-        url_response = url_response.decode("utf-8")
-    except urllib.error.URLError as e:
+    except (OSError, http.client.HTTPException, HTTPResponseError) as e:
         print('ERROR: Failed to reach the server')
-        print('ERROR: Reason =', e.reason)
+        print('ERROR: Reason =', e)
         return None
     except Exception as e:
         print('ERROR: Unable to process response')
@@ -61,7 +216,6 @@ def processQuery(query_url, header_dict, expect_code, query_dict, verbose=False,
 
     # Convert the response to JSON so we can process it easily.
     if expect_format == 'tsv':
-        # TODO: we should probably try to parse when TSV data is returned
         return url_response
 
     try:
@@ -97,24 +251,197 @@ def getHeaderDict():
                    'Content-Type': 'application/json'}
     return header_dict
 
-def getAuthToken(base_url, user, password, verbose=False):
-    header_dict = getHeaderDict()
-    full_url = base_url + '/token'
-    data_dict = { "username": user, "password": password }
-    token_json = processQuery(full_url, header_dict, 200, data_dict)
-    if token_json is None:
+def getAuthToken(base_url, user, password, verbose=False, token_cache=None):
+    # Log in with the shared API client on the same connections as the
+    # tests. A token cached by an earlier run for the same user is reused
+    # until it is close to expiring.
+    cache = tapis_client.TokenCache(token_cache) if token_cache else None
+    client = tapis_client.TapisClient(base_url, connection_pool, cache)
+    try:
+        token = client.authenticate(user, password)
+    except (OSError, http.client.HTTPException, HTTPResponseError, ValueError) as e:
         print("ERROR: Failed to authenticate.")
+        print('ERROR: Reason =', e)
         return None
     if verbose:
-        print(token_json)
-    return token_json['result']['access_token']
+        print(token)
+    return token['access_token']
 
-def initHTTP():
+def initHTTP(pool_size=4, record=None):
+    global connection_pool
     # Deafult OS do not have create cient certificate bundles. It is
     # easiest for us to ignore HTTPS certificate errors in this case.
     if (not os.environ.get('PYTHONHTTPSVERIFY', '') and
         getattr(ssl, '_create_unverified_context', None)): 
         ssl._create_default_https_context = ssl._create_unverified_context
+    # Persistent connections reused across all requests
+    connection_pool = ConnectionPool(pool_size)
+    if record:
+        connection_pool.recorder = FixtureRecorder(record)
+
+def findSchemaFiles():
+    # AIRR and VDJServer schema definitions from the vdjserver-schema
+    # submodule, VDJServer definitions take precedence.
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app', 'vdjserver-schema')
+    files = sorted(glob.glob(os.path.join(root, 'specs', '*.yaml')))
+    files += sorted(glob.glob(os.path.join(root, 'airr-standards', 'specs', '*.yaml')))
+    return files
+
+# set in main from --data-dir
+data_directory = 'data'
+
+# set in main from --schema, loaded on first use
+schema_files = []
+schema_definitions = None
+schema_lock = threading.Lock()
+
+# set in main from --api-spec, loaded on first use
+api_spec_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'swagger', 'vdjserver-api.yaml')
+api_spec = None
+
+# compiled response assertions of the test entries
+assertion_cache = response_assertions.AssertionCache()
+
+def schemaDefinitions():
+    global schema_definitions
+    with schema_lock:
+        if schema_definitions is None:
+            schema_definitions = {}
+            for filename in schema_files:
+                with open(filename, 'r') as fp:
+                    spec = yaml.safe_load(fp)
+                for key in spec:
+                    if key not in schema_definitions:
+                        schema_definitions[key] = spec[key]
+    return schema_definitions
+
+def apiSpec():
+    # The OpenAPI definition, its component schemas are in the schema files
+    global api_spec
+    definitions = schemaDefinitions()
+    with schema_lock:
+        if api_spec is None:
+            with open(api_spec_file, 'r') as fp:
+                api_spec = response_assertions.OpenAPISpec(yaml.safe_load(fp), definitions)
+    return api_spec
+
+def schemaColumns(name):
+    # Columns of a metadata table export for a schema object, following
+    # ProjectController.exportTable: arrays and non-ontology objects are
+    # not exported as columns.
+    definition = schemaDefinitions().get(name)
+    if not isinstance(definition, dict) or not isinstance(definition.get('properties'), dict):
+        return None
+    columns = []
+    for prop, prop_schema in definition['properties'].items():
+        prop_type = prop_schema.get('type')
+        if prop_type is None and prop_schema.get('$ref'):
+            prop_type = 'object'
+        is_ontology = str(prop_schema.get('$ref', '')).endswith('Ontology') or prop_schema.get('x-airr', {}).get('format') == 'ontology'
+        if prop_type == 'array':
+            continue
+        if prop_type == 'object' and not is_ontology:
+            continue
+        columns.append(prop)
+    return columns
+
+def checkTSV(entry, tsv):
+    # Check the expectations for a TSV response, returns an error message
+    # or None when the response is valid.
+    if tsv.header is None:
+        return 'empty TSV response'
+    if tsv.bad_rows > 0:
+        return 'TSV row ' + str(tsv.first_bad_row) + ' has wrong number of fields (' + str(tsv.bad_rows) + ' bad rows)'
+    header = set(tsv.header)
+    if len(header) != len(tsv.header):
+        return 'duplicate TSV columns'
+    for column in entry.get('tsv_columns', []):
+        if column not in header:
+            return 'missing TSV column ' + column
+    if entry.get('tsv_schema'):
+        names = entry['tsv_schema']
+        if not isinstance(names, list):
+            names = [ names ]
+        expected = set(entry.get('tsv_extra_columns', [ 'vdjserver_uuid' ]))
+        for name in names:
+            columns = schemaColumns(name)
+            if columns is None:
+                return 'unknown schema ' + name
+            for column in columns:
+                if column not in header:
+                    return 'missing TSV column ' + column
+            expected.update(columns)
+        for column in tsv.header:
+            # array entries are exported as name.N.field
+            if column not in expected and not INDEXED_COLUMN_PATTERN.match(column):
+                return 'unexpected TSV column ' + column
+    if entry.get('tsv_rows') is not None and tsv.rows != entry['tsv_rows']:
+        return 'incorrect TSV row count ' + str(tsv.rows)
+    if entry.get('tsv_min_rows') is not None and tsv.rows < entry['tsv_min_rows']:
+        return 'incorrect TSV row count ' + str(tsv.rows)
+    return None
+
+generate_lock = threading.Lock()
+
+def generatedDataFile(spec):
+    # Synthetic metadata for an entry with a generate key, written once to
+    # the generated directory under the data directory and then reused.
+    output_format = spec.get('format', 'airr')
+    repertoires = int(spec.get('repertoires', 10))
+    seed = int(spec.get('seed', 0))
+    per_subject = int(spec.get('repertoires_per_subject', 4))
+    directory = os.path.join(data_directory, 'generated')
+    filename = os.path.join(directory, generate_metadata.outputFilename(output_format, repertoires, seed, per_subject))
+    with generate_lock:
+        if not os.path.exists(filename):
+            os.makedirs(directory, exist_ok=True)
+            print('INFO: Generating', filename)
+            generate_metadata.generateFile(filename, output_format, repertoires, seed, per_subject)
+    if output_format == 'airr':
+        return filename, 'application/json'
+    return filename, 'text/tab-separated-values'
+
+def closeHTTP(options):
+    if options.connection_stats:
+        connection_pool.printStats()
+    connection_pool.close()
+    if connection_pool.recorder is not None:
+        print('RECORDED:', connection_pool.recorder.count, 'requests to', options.record)
+        connection_pool.recorder.close()
+
+def checkResponse(entry, data_json, method, code):
+    # The response and assert checks of the entry are compiled on first use
+    # and shared by every replay of the entry
+    try:
+        checks = assertion_cache.checks(entry)
+    except (response_assertions.AssertionSpecError, re.error) as e:
+        return 'invalid assertion: ' + str(e)
+    for check in checks:
+        message = check(data_json)
+        if message:
+            return message
+
+    # Validate against the response schema of the API definition, or the
+    # schema given by name
+    schema = entry.get('schema')
+    if schema:
+        try:
+            spec = apiSpec()
+        except IOError as e:
+            return 'cannot read API definition: ' + str(e)
+        if schema is True:
+            endpoint = entry['endpoint']
+            if endpoint.startswith('http://') or endpoint.startswith('https://'):
+                return 'no API schema for absolute URL, give the schema name'
+            validator, message = spec.validator(method, endpoint, code)
+            if validator is None:
+                return message
+        else:
+            validator = spec.schemaValidator(schema)
+        errors = response_assertions.validate(validator, data_json)
+        if errors:
+            return 'schema validation failed: ' + '; '.join(errors)
+    return None
 
 def testAPI(base_url, entry, auth, verbose, force):
     # Get the HTTP header information (in the form of a dictionary)
@@ -126,8 +453,11 @@ def testAPI(base_url, entry, auth, verbose, force):
         entry['result_message'] = 'invalid test entry'
         return
 
-    # Build the full URL
-    full_url = base_url + entry['endpoint']
+    # Build the full URL, an absolute URL can be used to reach other services
+    if entry['endpoint'].startswith('http://') or entry['endpoint'].startswith('https://'):
+        full_url = entry['endpoint']
+    else:
+        full_url = base_url + entry['endpoint']
 
     if entry['auth']:
         if auth is None:
@@ -145,21 +475,37 @@ def testAPI(base_url, entry, auth, verbose, force):
 
     expect_code = entry['code']
 
-    # assume POST method
-    if entry.get('method') == 'POST' or entry.get('method') is None:
-        if entry['data'] is None:
+    # assume POST method, PUT also sends a data file
+    method = entry.get('method')
+    if method is None:
+        method = 'POST'
+    if method in ['POST', 'PUT']:
+        if entry.get('data') is None and not entry.get('generate'):
             print("Test entry", entry['name'], "is missing data file.")
             entry['result'] = FAIL_STRING
             entry['result_message'] = 'invalid test entry'
             return
 
-        # assume files in data directory
-        data_file = "data/" + entry['data']
+        # assume files in data directory, generated files can be given with
+        # an absolute path or environment variables like ${IMPORT_DATA}
+        data_file = os.path.join(data_directory, os.path.expandvars(entry.get('data') or ''))
+        content_type = entry.get('content_type', 'application/json')
+        if entry.get('generate'):
+            try:
+                data_file, content_type = generatedDataFile(entry['generate'])
+            except Exception as error:
+                print("ERROR: Unable to generate data file for " + entry['name'] + ": " + str(error))
+                entry['result'] = FAIL_STRING
+                entry['result_message'] = 'cannot generate data file'
+                return
 
-        # Open the JSON query file and read it as a python dict.
+        # The data file is sent as is from disk. Small JSON files are still
+        # parsed first so that mistakes in the test data are caught.
         try:
-            with open(data_file, 'r') as f:
-                data_dict = json.load(f)
+            data_size = os.path.getsize(data_file)
+            if content_type == 'application/json' and data_size <= JSON_CHECK_SIZE:
+                with open(data_file, 'rb') as f:
+                    json.load(f)
         except IOError as error:
             print("ERROR: Unable to open JSON file " + data_file + ": " + str(error))
             entry['result'] = FAIL_STRING
@@ -168,8 +514,6 @@ def testAPI(base_url, entry, auth, verbose, force):
         except json.JSONDecodeError as error:
             if force:
                 print("WARNING: JSON Decode error detected in " + data_file + ": " + str(error))
-                with open(data_file, 'r') as f:
-                    data_dict = f.read().replace('\n', '')
             else:
                 print("ERROR: JSON Decode error detected in " + data_file + ": " + str(error))
                 entry['result'] = FAIL_STRING
@@ -180,6 +524,7 @@ def testAPI(base_url, entry, auth, verbose, force):
             entry['result'] = FAIL_STRING
             entry['result_message'] = 'cannot open JSON data file'
             return
+        data_dict = DataFileBody(data_file, content_type, entry.get('upload_gzip'), entry.get('upload_chunked'))
     else:
         # other methods like GET or DELETE
         data_dict = None
@@ -187,10 +532,14 @@ def testAPI(base_url, entry, auth, verbose, force):
     if verbose:
         print('INFO: Performing request on url:', full_url)
         if data_dict:
-            print('INFO: Performing POST request with data: ' + str(data_dict))
+            print('INFO: Performing ' + method + ' request with data file: ' + data_file + ' (' + str(data_size) + ' bytes)')
 
     # Perform the request.
-    data_json = processQuery(full_url, header_dict, expect_code, data_dict, verbose, force)
+    timing = {}
+    expect_format = entry.get('response_format', 'json')
+    data_json = processQuery(full_url, header_dict, expect_code, data_dict, verbose, force, expect_format, timing, method)
+    if timing.get('total') is not None:
+        entry['timing'] = timing
     if data_json is None:
         entry['result'] = FAIL_STRING
         entry['result_message'] = 'error with request'
@@ -198,6 +547,16 @@ def testAPI(base_url, entry, auth, verbose, force):
     if verbose:
         print('INFO: response: ' + str(data_json))
 
+    # Check a streamed TSV response
+    if expect_format == 'tsv':
+        message = checkTSV(entry, data_json)
+        if message:
+            entry['result'] = FAIL_STRING
+            entry['result_message'] = message
+            return
+        entry['result'] = PASS_STRING
+        return
+
     # Check the response type
     if entry.get('response_type'):
         if type(data_json).__name__ != entry['response_type']:
@@ -206,48 +565,20 @@ def testAPI(base_url, entry, auth, verbose, force):
             return
 
     # Check the response
-    if entry.get('response'):
-        for resp in entry['response']:
-            if entry.get('response_type') == 'list':
-                # response could be in any of the list entries
-                found = False
-                for dresp in data_json:
-                    if entry['response'][resp] in dresp.get(resp):
-                        found = True
-                if not found:
-                    entry['result'] = FAIL_STRING
-                    entry['result_message'] = 'incorrect response for ' + resp
-                    return
-            else:
-                if data_json.get(resp) is None:
-                    entry['result'] = FAIL_STRING
-                    entry['result_message'] = 'incorrect response for ' + resp
-                    return
-                if entry['response'][resp] not in data_json[resp]:
-                    entry['result'] = FAIL_STRING
-                    entry['result_message'] = 'incorrect response for ' + resp
-                    return
+    message = checkResponse(entry, data_json, method, expect_code)
+    if message:
+        entry['result'] = FAIL_STRING
+        entry['result_message'] = message
+        return
 
     entry['result'] = PASS_STRING
     return
 
-def getArguments():
-    # Set up the command line parser
-    parser = argparse.ArgumentParser(
-        formatter_class=argparse.RawDescriptionHelpFormatter,
-        description=""
-    )
-
+def addCommonArguments(parser):
     # The URL for the API
     parser.add_argument("base_url")
     # yaml file containing list of tests.
     parser.add_argument("test_list")
-    # run single test
-    parser.add_argument(
-        "-s",
-        "--single",
-        type=str,
-        help="Run single test.")
     # username/password
     parser.add_argument(
         "-u",
@@ -265,6 +596,52 @@ def getArguments():
         action="store_const",
         const=True,
         help="Force sending bad JSON even when the JSON can't be loaded.")
+    # Connection pool
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=4,
+        help="Maximum number of persistent connections per host.")
+    parser.add_argument(
+        "--connection-stats",
+        action="store_true",
+        help="Report the number of connections opened and reused.")
+    parser.add_argument(
+        "--token-cache",
+        type=str,
+        default=tapis_client.DEFAULT_TOKEN_CACHE,
+        help="File for caching the login token between runs, empty to disable.")
+    # Fixture recording
+    parser.add_argument(
+        "--record",
+        type=str,
+        help="Record requests and responses to this file for replay with stub_server.py.")
+    # Sharding across runners
+    parser.add_argument(
+        "--shard",
+        type=str,
+        help="Only run shard i of N of the tests, given as i/N.")
+    parser.add_argument(
+        "--shard-durations",
+        type=str,
+        help="Results file of a previous run used to balance shards by test duration.")
+    # Test data
+    parser.add_argument(
+        "--data-dir",
+        type=str,
+        default="data",
+        help="Directory of data files for the test entries. Default is data.")
+    # Schema for TSV checks
+    parser.add_argument(
+        "--schema",
+        type=str,
+        action="append",
+        help="Schema YAML file for tsv_schema and schema checks, may be repeated. Default is the vdjserver-schema submodule.")
+    parser.add_argument(
+        "--api-spec",
+        type=str,
+        default=api_spec_file,
+        help="OpenAPI definition for schema checks. Default is swagger/vdjserver-api.yaml.")
     # Verbosity flag
     parser.add_argument(
         "-v",
@@ -272,44 +649,613 @@ def getArguments():
         action="store_true",
         help="Run the program in verbose mode.")
 
+def getArguments(argv=None):
+    # Set up the command line parser
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="",
+        epilog="Use 'test_driver.py benchmark -h' for load testing and 'test_driver.py merge -h' to merge sharded results."
+    )
+    addCommonArguments(parser)
+
+    # run single test
+    parser.add_argument(
+        "-s",
+        "--single",
+        type=str,
+        help="Run single test.")
+    # Concurrency
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of tests to run concurrently. Entries marked serial always run alone.")
+    # Machine readable results
+    parser.add_argument(
+        "--results",
+        type=str,
+        help="Write results and request timings to this file as JSON Lines.")
+    parser.add_argument(
+        "--prometheus",
+        type=str,
+        help="Write request timings to this file in Prometheus text format.")
+    parser.add_argument(
+        "--junit",
+        type=str,
+        help="Write results to this file as JUnit XML.")
+    parser.add_argument(
+        "--compare",
+        type=str,
+        help="Previous results file to compare endpoint latency against.")
+    parser.add_argument(
+        "--regression-threshold",
+        type=float,
+        default=0.25,
+        help="Fractional increase in median latency reported as a regression. Default is 0.25.")
+
     # Parse the command line arguements.
-    options = parser.parse_args()
+    options = parser.parse_args(argv)
     return options
 
+def getBenchmarkArguments(argv):
+    # Set up the command line parser
+    parser = argparse.ArgumentParser(
+        prog="test_driver.py benchmark",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="Replay test entries at a fixed request rate or concurrency and report latency per endpoint."
+    )
+    addCommonArguments(parser)
 
-if __name__ == "__main__":
-    # Get the command line arguments.
-    options = getArguments()
+    # select tests
+    parser.add_argument(
+        "-s",
+        "--select",
+        type=str,
+        action="append",
+        help="Name of test entry to replay, may be given multiple times. Default is all entries.")
+    # load shape
+    parser.add_argument(
+        "-d",
+        "--duration",
+        type=float,
+        default=30,
+        help="Duration of the benchmark in seconds.")
+    parser.add_argument(
+        "-r",
+        "--rate",
+        type=float,
+        help="Target request rate per second. Without a rate, each worker sends requests back to back.")
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        default=4,
+        help="Number of concurrent workers.")
 
-    auth = None
-    if options.user and options.password:
-        auth = getAuthToken(options.base_url, options.user, options.password, options.verbose)
-        if auth is None:
-            sys.exit(1)
+    # Parse the command line arguements.
+    options = parser.parse_args(argv)
+    return options
 
-    test_list = yaml.safe_load(open(options.test_list, 'r'))
-    #print("Number of tests:", len(test_list))
+def parseDuration(value):
+    # seconds, or a number with an s, m or h suffix
+    units = { 's': 1, 'm': 60, 'h': 3600 }
+    if value and value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
 
-    # Ensure our HTTP set up has been done.
-    initHTTP()
+def getSoakArguments(argv):
+    # Set up the command line parser
+    parser = argparse.ArgumentParser(
+        prog="test_driver.py soak",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="Replay a mix of test entries at a modest rate for hours and alert on latency drift and errors."
+    )
+    addCommonArguments(parser)
 
-    # perform the tests
-    for entry in test_list:
-        if options.single:
-            if entry['name'] != options.single:
+    # select tests
+    parser.add_argument(
+        "-s",
+        "--select",
+        type=str,
+        action="append",
+        help="Test entry in the mix, given as NAME or NAME=WEIGHT, may be given multiple times. Default is all entries.")
+    # load shape
+    parser.add_argument(
+        "-d",
+        "--duration",
+        type=parseDuration,
+        default=4 * 3600,
+        help="Duration of the soak in seconds, or with an m or h suffix.")
+    parser.add_argument(
+        "-r",
+        "--rate",
+        type=float,
+        default=2.0,
+        help="Request rate per second.")
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        default=2,
+        help="Number of concurrent workers.")
+    # trend detection
+    parser.add_argument(
+        "-w",
+        "--window",
+        type=parseDuration,
+        default=300,
+        help="Length of each window in seconds, or with an m or h suffix.")
+    parser.add_argument(
+        "--trend-windows",
+        type=int,
+        default=12,
+        help="Number of recent windows used to fit the p95 latency trend.")
+    parser.add_argument(
+        "--slope-threshold",
+        type=float,
+        default=25.0,
+        help="Alert when p95 latency rises faster than this many milliseconds per hour.")
+    parser.add_argument(
+        "--error-threshold",
+        type=float,
+        default=0.01,
+        help="Alert when the fraction of failed requests in a window is above this.")
+    # service status
+    parser.add_argument(
+        "--status-interval",
+        type=parseDuration,
+        help="Sample the service status every this many seconds.")
+    parser.add_argument(
+        "--status-path",
+        type=str,
+        action="append",
+        help="Path sampled with GET for the service status, may be given multiple times. Default is /.")
+    # output
+    parser.add_argument(
+        "--results",
+        type=str,
+        help="Write a JSON summary of every window to this file.")
+
+    # Parse the command line arguements.
+    options = parser.parse_args(argv)
+    return options
+
+def printResult(entry):
+    if entry['result'] == FAIL_STRING:
+        print(entry['result'] + ':', entry['name'], '-', entry['result_message'])
+    else:
+        print(entry['result'] + ':', entry['name'])
+
+def runTests(base_url, test_list, auth, options):
+    # Entries are started in YAML order on a bounded worker pool, and the
+    # results are printed in that same order. An entry marked with
+    # "serial: true" waits for all running entries to finish and runs
+    # alone, so tests which depend on earlier state can be sequenced.
+    jobs = max(1, options.jobs)
+    pending = []
+
+    def drain():
+        while pending:
+            entry, future = pending.pop(0)
+            future.result()
+            printResult(entry)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for entry in test_list:
+            if options.single:
+                if entry['name'] != options.single:
+                    entry['result'] = SKIP_STRING
+                    continue
+            if entry.get('skip'):
+                drain()
                 entry['result'] = SKIP_STRING
-                continue
-        if entry.get('skip'):
-            entry['result'] = SKIP_STRING
-            print('SKIP:', entry['name'])
-        else:
-            testAPI(options.base_url, entry, auth, options.verbose, options.force)
-            if entry['result'] == FAIL_STRING:
-                print(entry['result'] + ':', entry['name'], '-', entry['result_message'])
+                print('SKIP:', entry['name'])
+            elif jobs == 1 or entry.get('serial'):
+                drain()
+                testAPI(base_url, entry, auth, options.verbose, options.force)
+                printResult(entry)
             else:
-                print(entry['result'] + ':', entry['name'])
+                pending.append((entry, executor.submit(testAPI, base_url, entry, auth, options.verbose, options.force)))
+                # print any leading results which are already done
+                while pending and pending[0][1].done():
+                    entry, future = pending.pop(0)
+                    future.result()
+                    printResult(entry)
+        drain()
 
-    # print summary
+def endpointKey(entry):
+    # Group requests by method and endpoint, with UUIDs in the path
+    # replaced so that the same route is reported together.
+    method = entry.get('method')
+    if method is None:
+        method = 'POST'
+    path = UUID_PATTERN.sub('{uuid}', entry['endpoint'])
+    return method + ' ' + path
+
+def percentile(sorted_values, pct):
+    # nearest rank percentile of an already sorted list
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(sorted_values)))
+    return sorted_values[max(rank, 1) - 1]
+
+class BenchmarkStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = {}
+        self.errors = {}
+
+    def record(self, key, elapsed, failed):
+        with self.lock:
+            self.latency.setdefault(key, []).append(elapsed)
+            if failed:
+                self.errors[key] = self.errors.get(key, 0) + 1
+            else:
+                self.errors.setdefault(key, 0)
+
+    def printReport(self, elapsed):
+        print('')
+        print('BENCHMARK SUMMARY')
+        print('-----------------')
+        print('DURATION: %.1fs' % elapsed)
+        total = 0
+        errors = 0
+        header = '%-50s %8s %8s %7s %9s %9s %9s %9s' % ('ENDPOINT', 'REQUESTS', 'REQ/S', 'ERROR%', 'P50(ms)', 'P90(ms)', 'P99(ms)', 'MAX(ms)')
+        print(header)
+        for key in sorted(self.latency):
+            values = sorted(self.latency[key])
+            total += len(values)
+            errors += self.errors[key]
+            print('%-50s %8d %8.1f %7.2f %9.1f %9.1f %9.1f %9.1f' % (key, len(values), len(values) / elapsed,
+                100.0 * self.errors[key] / len(values), 1000 * percentile(values, 50), 1000 * percentile(values, 90),
+                1000 * percentile(values, 99), 1000 * values[-1]))
+        print('TOTAL: %d requests, %.1f req/s, %d errors' % (total, total / elapsed if elapsed > 0 else 0, errors))
+        return errors
+
+def benchmarkRequest(base_url, entry, auth, options, stats, scheduled=None):
+    # testAPI() stores the result on the entry, so replay a copy. Latency is
+    # measured from the scheduled start when there is one, so time spent
+    # waiting for a free worker is counted rather than omitted.
+    test_entry = dict(entry)
+    start = time.perf_counter() if scheduled is None else scheduled
+    testAPI(base_url, test_entry, auth, options.verbose, options.force)
+    stats.record(endpointKey(entry), time.perf_counter() - start, test_entry['result'] != PASS_STRING)
+
+def runBenchmark(base_url, test_list, auth, options, stats=None):
+    # Replay the selected entries round robin until the duration has elapsed.
+    # With a target rate the requests are started on a fixed schedule and
+    # handed to the workers; otherwise each worker sends its next request as
+    # soon as the previous one completes.
+    entries = [entry for entry in test_list if not entry.get('skip')]
+    if options.select:
+        entries = [entry for entry in entries if entry['name'] in options.select]
+    if len(entries) == 0:
+        print('ERROR: No test entries selected for benchmark.')
+        return None, 0
+
+    if stats is None:
+        stats = BenchmarkStats()
+    workers = max(1, options.concurrency)
+    next_entry = itertools.cycle(entries)
+    lock = threading.Lock()
+    start = time.perf_counter()
+    deadline = start + options.duration
+
+    if options.rate:
+        interval = 1.0 / options.rate
+        slots = threading.BoundedSemaphore(workers)
+        late = 0
+
+        def worker(entry, scheduled):
+            try:
+                benchmarkRequest(base_url, entry, auth, options, stats, scheduled)
+            finally:
+                slots.release()
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            scheduled = start
+            while scheduled < deadline:
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                if not slots.acquire(blocking=False):
+                    # all workers are busy so the target rate is not being met
+                    late += 1
+                    slots.acquire()
+                    if time.perf_counter() >= deadline:
+                        slots.release()
+                        break
+                executor.submit(worker, next(next_entry), scheduled)
+                scheduled += interval
+        if late > 0:
+            print('WARNING:', late, 'requests started late because all workers were busy.')
+    else:
+        def worker():
+            while time.perf_counter() < deadline:
+                with lock:
+                    entry = next(next_entry)
+                benchmarkRequest(base_url, entry, auth, options, stats)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for i in range(workers):
+                executor.submit(worker)
+
+    return stats, time.perf_counter() - start
+
+def latencySlope(points):
+    # Least squares slope of (hours, milliseconds) points in ms per hour
+    if len(points) < 3:
+        return None
+    mean_x = sum(x for x, y in points) / len(points)
+    mean_y = sum(y for x, y in points) / len(points)
+    var_x = sum((x - mean_x) ** 2 for x, y in points)
+    if var_x == 0:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x
+
+class SoakStats:
+    # Latencies are kept for the current window only. When a window closes
+    # it is reduced to a summary, so memory stays flat however long the
+    # soak runs. The p95 latency of the recent windows is fitted to a line
+    # and an alert is printed when it rises faster than the threshold.
+    def __init__(self, options):
+        self.lock = threading.Lock()
+        self.trend_windows = options.trend_windows
+        self.slope_threshold = options.slope_threshold
+        self.error_threshold = options.error_threshold
+        self.results = open(options.results, 'w') if options.results else None
+        self.start = time.perf_counter()
+        self.window_start = self.start
+        self.latency = {}
+        self.errors = {}
+        self.status = {}
+        self.windows = []
+        self.alerts = 0
+
+    def record(self, key, elapsed, failed):
+        with self.lock:
+            self.latency.setdefault(key, []).append(elapsed)
+            self.errors[key] = self.errors.get(key, 0) + (1 if failed else 0)
+
+    def recordStatus(self, path, elapsed, ok):
+        with self.lock:
+            self.status.setdefault(path, []).append((elapsed, ok))
+
+    def pending(self):
+        # whether the current window has any requests or status samples
+        with self.lock:
+            return bool(self.latency or self.status)
+
+    def alert(self, message):
+        self.alerts += 1
+        print('ALERT:', message)
+
+    def _trend(self, key):
+        points = []
+        for window in self.windows[-self.trend_windows:]:
+            summary = window['endpoints'].get(key) if key else window
+            if summary and summary['requests'] > 0:
+                points.append(((window['start'] + window['end']) / 7200.0, summary['p95_ms']))
+        return latencySlope(points)
+
+    def closeWindow(self):
+        now = time.perf_counter()
+        with self.lock:
+            latency, errors, status = self.latency, self.errors, self.status
+            self.latency, self.errors, self.status = {}, {}, {}
+            window_start, self.window_start = self.window_start, now
+
+        def summarize(values, error_count):
+            values = sorted(values)
+            return {
+                'requests': len(values),
+                'errors': error_count,
+                'p50_ms': 1000 * percentile(values, 50) if values else None,
+                'p95_ms': 1000 * percentile(values, 95) if values else None,
+                'p99_ms': 1000 * percentile(values, 99) if values else None
+            }
+
+        window = summarize([v for values in latency.values() for v in values], sum(errors.values()))
+        window.update({ 'window': len(self.windows) + 1, 'start': window_start - self.start, 'end': now - self.start })
+        window['endpoints'] = { key: summarize(latency[key], errors[key]) for key in sorted(latency) }
+        window['status'] = {}
+        for path, samples in status.items():
+            window['status'][path] = {
+                'samples': len(samples),
+                'failures': sum(1 for elapsed, ok in samples if not ok),
+                'mean_ms': 1000 * sum(elapsed for elapsed, ok in samples) / len(samples)
+            }
+        self.windows.append(window)
+        window['p95_slope'] = self._trend(None)
+        for key, summary in window['endpoints'].items():
+            summary['p95_slope'] = self._trend(key)
+
+        duration = window['end'] - window['start']
+        line = 'SOAK WINDOW %d: %d requests, %.1f req/s, %d errors' % (window['window'], window['requests'], window['requests'] / duration if duration > 0 else 0, window['errors'])
+        if window['requests'] > 0:
+            line += ', p50 %.1fms, p95 %.1fms, p99 %.1fms' % (window['p50_ms'], window['p95_ms'], window['p99_ms'])
+        if window['p95_slope'] is not None:
+            line += ', p95 trend %+.1fms/hour' % window['p95_slope']
+        for path, summary in sorted(window['status'].items()):
+            line += ', GET %s %.1fms %d/%d failed' % (path, summary['mean_ms'], summary['failures'], summary['samples'])
+        print(line)
+
+        if window['p95_slope'] is not None and window['p95_slope'] > self.slope_threshold:
+            self.alert('p95 latency rising %.1fms/hour over the last %d windows' % (window['p95_slope'], min(len(self.windows), self.trend_windows)))
+        for key, summary in window['endpoints'].items():
+            if summary['p95_slope'] is not None and summary['p95_slope'] > self.slope_threshold:
+                self.alert('%s p95 latency rising %.1fms/hour' % (key, summary['p95_slope']))
+        if window['requests'] > 0 and window['errors'] / window['requests'] > self.error_threshold:
+            self.alert('error rate %.1f%% in window %d' % (100.0 * window['errors'] / window['requests'], window['window']))
+        for path, summary in window['status'].items():
+            if summary['failures'] > 0:
+                self.alert('GET %s failed %d of %d times in window %d' % (path, summary['failures'], summary['samples'], window['window']))
+
+        if self.results:
+            self.results.write(json.dumps(window) + '\n')
+            self.results.flush()
+
+    def printReport(self, elapsed):
+        print('')
+        print('SOAK SUMMARY')
+        print('------------')
+        print('DURATION: %.1fs in %d windows' % (elapsed, len(self.windows)))
+        active = [window for window in self.windows if window['requests'] > 0]
+        total = sum(window['requests'] for window in self.windows)
+        errors = sum(window['errors'] for window in self.windows)
+        print('TOTAL: %d requests, %.1f req/s, %d errors' % (total, total / elapsed if elapsed > 0 else 0, errors))
+        if active:
+            print('P95: first window %.1fms, last window %.1fms' % (active[0]['p95_ms'], active[-1]['p95_ms']))
+        print('ALERTS:', self.alerts)
+        if self.results:
+            self.results.close()
+        return self.alerts
+
+def sampleStatus(base_url, path, stats):
+    # Service status requests are timed separately from the endpoint mix
+    start = time.perf_counter()
+    try:
+        code, headers, data = connection_pool.request('GET', base_url + path, None, { 'Accept': 'application/json' })
+        ok = code == 200
+    except (OSError, http.client.HTTPException, HTTPResponseError):
+        ok = False
+    stats.recordStatus(path, time.perf_counter() - start, ok)
+
+def soakEntries(test_list, select):
+    # Entries of the mix given as NAME or NAME=WEIGHT, an entry with weight
+    # N is repeated N times in the round robin
+    entries = [entry for entry in test_list if not entry.get('skip')]
+    if not select:
+        return entries
+    by_name = { entry['name']: entry for entry in entries }
+    mix = []
+    for item in select:
+        name, weight = item, 1
+        if '=' in item:
+            name, weight = item.rsplit('=', 1)
+            if not weight.isdigit() or int(weight) < 1:
+                print('ERROR: Weight of', name, 'must be a positive integer, not', weight)
+                return []
+            weight = int(weight)
+        if name not in by_name:
+            print('ERROR: No test entry named', name)
+            return []
+        mix.extend([by_name[name]] * weight)
+    return mix
+
+def runSoak(base_url, test_list, auth, options):
+    entries = soakEntries(test_list, options.select)
+    if len(entries) == 0:
+        print('ERROR: No test entries selected for soak.')
+        return None, 0
+    stats = SoakStats(options)
+    stop = threading.Event()
+
+    def monitor():
+        # close windows and sample the service status on schedule
+        next_window = stats.start + options.window
+        next_status = stats.start
+        while not stop.wait(0.5):
+            now = time.perf_counter()
+            if options.status_interval and now >= next_status:
+                for path in options.status_path or ['/']:
+                    sampleStatus(base_url, path, stats)
+                next_status += options.status_interval
+            if now >= next_window:
+                stats.closeWindow()
+                next_window += options.window
+
+    thread = threading.Thread(target=monitor, daemon=True)
+    thread.start()
+    soak_options = argparse.Namespace(**vars(options))
+    soak_options.select = None
+    result, elapsed = runBenchmark(base_url, entries, auth, soak_options, stats)
+    stop.set()
+    thread.join()
+    # the last partial window, however short
+    if stats.pending():
+        stats.closeWindow()
+    return stats, elapsed
+
+TIMING_PHASES = ['dns', 'connect', 'tls', 'send', 'ttfb', 'transfer', 'total']
+
+def resultRecord(entry):
+    record = { 'name': entry['name'], 'result': entry.get('result') }
+    if entry.get('endpoint') is not None:
+        record['endpoint'] = endpointKey(entry)
+    if entry.get('result_message'):
+        record['result_message'] = entry['result_message']
+    if entry.get('timing'):
+        record['timing'] = entry['timing']
+    return record
+
+def writeResults(test_list, filename):
+    # One JSON object per line for each test entry
+    with open(filename, 'w') as fp:
+        for entry in test_list:
+            fp.write(json.dumps(resultRecord(entry)) + '\n')
+
+def prometheusLabel(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def writePrometheus(test_list, filename):
+    # Prometheus text exposition format, suitable for the node exporter
+    # textfile collector or a push gateway.
+    timed = [entry for entry in test_list if entry.get('timing')]
+    with open(filename, 'w') as fp:
+        fp.write('# HELP vdj_api_test_request_seconds Duration of each phase of a test request.\n')
+        fp.write('# TYPE vdj_api_test_request_seconds gauge\n')
+        for entry in timed:
+            labels = 'test="%s",endpoint="%s"' % (prometheusLabel(entry['name']), prometheusLabel(endpointKey(entry)))
+            for phase in TIMING_PHASES:
+                fp.write('vdj_api_test_request_seconds{%s,phase="%s"} %f\n' % (labels, phase, entry['timing'][phase]))
+        fp.write('# HELP vdj_api_test_request_bytes Size of the request and response bodies of a test request.\n')
+        fp.write('# TYPE vdj_api_test_request_bytes gauge\n')
+        for entry in timed:
+            labels = 'test="%s",endpoint="%s"' % (prometheusLabel(entry['name']), prometheusLabel(endpointKey(entry)))
+            fp.write('vdj_api_test_request_bytes{%s,direction="request"} %d\n' % (labels, entry['timing']['request_bytes']))
+            fp.write('vdj_api_test_request_bytes{%s,direction="response"} %d\n' % (labels, entry['timing']['response_bytes']))
+        fp.write('# HELP vdj_api_test_result Test result, 1 for PASS and 0 otherwise.\n')
+        fp.write('# TYPE vdj_api_test_result gauge\n')
+        for entry in test_list:
+            if entry.get('result') == SKIP_STRING:
+                continue
+            fp.write('vdj_api_test_result{test="%s"} %d\n' % (prometheusLabel(entry['name']), 1 if entry.get('result') == PASS_STRING else 0))
+
+def loadResults(filename):
+    results = []
+    with open(filename, 'r') as fp:
+        for line in fp:
+            if line.strip():
+                results.append(json.loads(line))
+    return results
+
+def endpointLatency(records):
+    # median total latency for each endpoint
+    latency = {}
+    for record in records:
+        if record.get('timing') and record.get('endpoint'):
+            latency.setdefault(record['endpoint'], []).append(record['timing']['total'])
+    return { key: percentile(sorted(values), 50) for key, values in latency.items() }
+
+def compareResults(previous, current, threshold):
+    # Flag endpoints whose median latency grew by more than the threshold
+    # fraction compared to the previous run.
+    regressions = []
+    previous_latency = endpointLatency(previous)
+    current_latency = endpointLatency(current)
+    for key in sorted(current_latency):
+        if previous_latency.get(key) is None:
+            continue
+        if current_latency[key] > previous_latency[key] * (1.0 + threshold):
+            regressions.append(key)
+            print('REGRESSION: %s median latency %.1fms -> %.1fms' % (key,
+                1000 * previous_latency[key], 1000 * current_latency[key]))
+    return regressions
+
+def printSummary(test_list):
+    # print summary, returns the number of failures
     skip_cnt = 0
     pass_cnt = 0
     fail_cnt = 0
@@ -332,6 +1278,197 @@ if __name__ == "__main__":
     print(' SKIP:', skip_cnt)
     if unknown_cnt > 0:
         print(' ??? :', unknown_cnt)
+    return fail_cnt
+
+def writeJUnit(records, filename):
+    # JUnit XML report for CI systems from result records
+    suite = ElementTree.Element('testsuite', name='vdjserver-api')
+    failures = 0
+    skipped = 0
+    total_time = 0.0
+    for record in records:
+        elapsed = record['timing']['total'] if record.get('timing') else 0.0
+        total_time += elapsed
+        case = ElementTree.SubElement(suite, 'testcase', name=record['name'], classname=record.get('endpoint', 'test_driver'), time='%.3f' % elapsed)
+        if record['result'] == FAIL_STRING:
+            failures += 1
+            ElementTree.SubElement(case, 'failure', message=str(record.get('result_message')))
+        elif record['result'] != PASS_STRING:
+            skipped += 1
+            ElementTree.SubElement(case, 'skipped')
+    suite.set('tests', str(len(records)))
+    suite.set('failures', str(failures))
+    suite.set('errors', '0')
+    suite.set('skipped', str(skipped))
+    suite.set('time', '%.3f' % total_time)
+    testsuites = ElementTree.Element('testsuites')
+    testsuites.append(suite)
+    ElementTree.ElementTree(testsuites).write(filename, encoding='utf-8', xml_declaration=True)
+
+def parseShard(shard):
+    # "i/N" with shards numbered from 1
+    try:
+        index, count = [int(value) for value in shard.split('/')]
+    except ValueError:
+        index, count = 0, 0
+    if count < 1 or index < 1 or index > count:
+        print('ERROR: Invalid shard ' + shard + ', expecting i/N with 1 <= i <= N.')
+        sys.exit(1)
+    return index, count
+
+def selectShard(test_list, shard, durations_file=None):
+    # Deterministically split the tests into shards. Entries with the same
+    # shard_group stay on the same shard, so tests which depend on each
+    # other run together in their original order. By default groups are
+    # assigned by a hash of their name. With the results of a previous run,
+    # groups are instead assigned longest first to the shard with the least
+    # total duration so far, which balances the time each shard takes.
+    index, count = parseShard(shard)
+    groups = {}
+    for entry in test_list:
+        groups.setdefault(str(entry.get('shard_group', entry['name'])), []).append(entry)
+
+    if durations_file:
+        durations = {}
+        for record in loadResults(durations_file):
+            if record.get('timing'):
+                durations[record['name']] = record['timing']['total']
+        default = percentile(sorted(durations.values()), 50) or 1.0
+        group_time = {}
+        for group, entries in groups.items():
+            group_time[group] = sum(durations.get(entry['name'], default) for entry in entries)
+        load = [0.0] * count
+        assignment = {}
+        for group in sorted(groups, key=lambda g: (-group_time[g], g)):
+            target = min(range(count), key=lambda i: (load[i], i))
+            load[target] += group_time[group]
+            assignment[group] = target
+    else:
+        assignment = { group: zlib.crc32(group.encode('utf-8')) % count for group in groups }
+
+    selected = [entry for entry in test_list if assignment[str(entry.get('shard_group', entry['name']))] == index - 1]
+    print('SHARD: ' + shard + ',', len(selected), 'of', len(test_list), 'tests')
+    return selected
+
+def mergeMain(argv):
+    # Combine the results files of shards into one summary and exit code
+    parser = argparse.ArgumentParser(
+        prog="test_driver.py merge",
+        description="Merge results files from sharded runs into a single report."
+    )
+    parser.add_argument("results_files", nargs='+', help="Results files written with --results.")
+    parser.add_argument(
+        "--results",
+        type=str,
+        help="Write the merged results to this file as JSON Lines.")
+    parser.add_argument(
+        "--junit",
+        type=str,
+        help="Write the merged results to this file as JUnit XML.")
+    options = parser.parse_args(argv)
+
+    test_list = []
+    seen = set()
+    for filename in options.results_files:
+        try:
+            records = loadResults(filename)
+        except (OSError, ValueError) as e:
+            # a missing shard must fail the merged run
+            print('ERROR: Unable to read results file', filename + ':', e)
+            sys.exit(1)
+        for record in records:
+            if record['name'] in seen:
+                print('WARNING: Test', record['name'], 'appears in more than one results file.')
+            seen.add(record['name'])
+            test_list.append(record)
+
+    for entry in test_list:
+        printResult(entry)
+    fail_cnt = printSummary(test_list)
+    if options.results:
+        with open(options.results, 'w') as fp:
+            for record in test_list:
+                fp.write(json.dumps(record) + '\n')
+    if options.junit:
+        writeJUnit(test_list, options.junit)
+    sys.exit(fail_cnt)
+
+def setupRun(options, pool_size):
+    global data_directory, schema_files, api_spec_file
+    if options.shard:
+        parseShard(options.shard)
+    # Ensure our HTTP set up has been done.
+    initHTTP(pool_size, options.record)
+    schema_files = options.schema if options.schema else findSchemaFiles()
+    api_spec_file = options.api_spec
+    data_directory = options.data_dir
+
+    auth = None
+    if options.user and options.password:
+        # a recorded run must log in so the fixtures include /token
+        token_cache = None if options.record else options.token_cache
+        auth = getAuthToken(options.base_url, options.user, options.password, options.verbose, token_cache)
+        if auth is None:
+            sys.exit(1)
+
+    test_list = yaml.safe_load(open(options.test_list, 'r'))
+    #print("Number of tests:", len(test_list))
+    if options.shard:
+        test_list = selectShard(test_list, options.shard, options.shard_durations)
+    return auth, test_list
+
+def benchmarkMain(argv):
+    options = getBenchmarkArguments(argv)
+    auth, test_list = setupRun(options, max(options.pool_size, options.concurrency))
+
+    stats, elapsed = runBenchmark(options.base_url, test_list, auth, options)
+    if stats is None:
+        sys.exit(1)
+    errors = stats.printReport(elapsed)
+    closeHTTP(options)
+    sys.exit(1 if errors > 0 else 0)
+
+def soakMain(argv):
+    options = getSoakArguments(argv)
+    auth, test_list = setupRun(options, max(options.pool_size, options.concurrency + 1))
+
+    stats, elapsed = runSoak(options.base_url, test_list, auth, options)
+    if stats is None:
+        sys.exit(1)
+    alerts = stats.printReport(elapsed)
+    closeHTTP(options)
+    sys.exit(1 if alerts > 0 else 0)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        benchmarkMain(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'soak':
+        soakMain(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'merge':
+        mergeMain(sys.argv[2:])
+
+    # Get the command line arguments.
+    options = getArguments()
+    auth, test_list = setupRun(options, max(options.pool_size, options.jobs))
+
+    # perform the tests
+    runTests(options.base_url, test_list, auth, options)
+
+    # print summary
+    fail_cnt = printSummary(test_list)
+    closeHTTP(options)
+
+    # timing output
+    if options.results:
+        writeResults(test_list, options.results)
+    if options.prometheus:
+        writePrometheus(test_list, options.prometheus)
+    if options.junit:
+        writeJUnit([resultRecord(entry) for entry in test_list], options.junit)
+    if options.compare:
+        current = [resultRecord(entry) for entry in test_list]
+        regressions = compareResults(loadResults(options.compare), current, options.regression_threshold)
+        print('REGRESSIONS:', len(regressions))
 
     # exit with proper code
     error_code = fail_cnt